@@ -14,8 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 import logging
 import os
+import requests
 import time
 
 from ochopod.bindings.generic.marathon import Pod
@@ -39,6 +41,8 @@ if __name__ == '__main__':
         
         check_every = 60.0
 
+        grace = float(os.environ.get('OCHOPOD_GRACE', 30)) + 5.0
+
         pid = None
 
         since = 0.0
@@ -56,10 +60,24 @@ if __name__ == '__main__':
 
             lapse = (now - self.since) / 3600.0
 
+            #
+            # - ask the portal how its shared zookeeper session is doing
+            # - don't fail the sanity check if the portal is not yet up
+            #
+            try:
+                reply = requests.get('http://localhost:9000/health', timeout=1.0)
+                zk = json.loads(reply.text)['zk']
+                health = '%s for %d seconds (%d re-connections)' % \
+                         ('connected' if zk['connected'] else 'disconnected', zk['for'], zk['reconnections'])
+
+            except Exception:
+                health = 'n/a'
+
             return \
                 {
                     'token': token,
-                    'uptime': '%.2f hours (pid %s)' % (lapse, pid)
+                    'uptime': '%.2f hours (pid %s)' % (lapse, pid),
+                    'zookeeper': health
                 }
 
         def configure(self, _):
@@ -83,7 +101,8 @@ if __name__ == '__main__':
                 masters = os.environ['MARATHON_MASTER']
 
             #
-            # - run the webserver
+            # - run the webserver (cheroot unless $OCHOPOD_SERVER says otherwise)
+            # - it will drain upon SIGTERM for up to $OCHOPOD_GRACE seconds (we allow a bit more before killing it)
             # - don't forget to pass the secret token as an environment variable
             #
             return 'python portal.py', \
@@ -20,20 +20,350 @@ import json
 import logging
 import ochopod
 import os
+import re
+import requests
+import shlex
+import signal
+import socket
 import sys
 import tempfile
 import time
 import shutil
+import uuid
 
-from flask import Flask, request
+from cheroot.wsgi import Server
+from flask import Flask, Response, request
 from ochopod.core.fsm import diagnostic
-from os.path import join
+from os.path import basename, exists, isdir, join
 from subprocess import Popen, PIPE
+from threading import Condition, Event, Lock, Thread
+from toolset import trace
+from toolset.io import attach, detach, generation, run, Pool
+from toolset.main import execute, load, uncaptured, Output
+from toolset.tool import Isolated
+from toolset.metrics import Counter, Histogram, render
 
 
 logger = logging.getLogger('ochopod')
 web = Flask(__name__)
 
+#: Zookeeper path under which each portal registers the jobs it runs.
+JOBS = '/ochothon/jobs'
+
+#: Valid blob identifier (e.g a SHA1 in hex).
+_SHA1 = re.compile('^[0-9a-f]{40}$')
+
+#: Command latency as seen by the portal (mode being either in-process, sub-process, cache or coalesced).
+COMMAND_SECONDS = Histogram('ochothon_command_seconds', 'Command latency.', ['command', 'mode'])
+
+#: Commands that returned a non-zero exit code.
+COMMAND_FAILURES = Counter('ochothon_command_failures_total', 'Commands that failed.', ['command'])
+
+#: Time it takes for a toolset sub-process to output its first line (or to exit), e.g including the interpreter
+#: startup and the toolset imports.
+SPAWN_SECONDS = Histogram('ochothon_spawn_seconds', 'Sub-process spawn latency (until its first output line).')
+
+
+class _Blobs(object):
+    """
+    Content-addressed store holding the files uploaded by the CLI, each one named after its SHA1. Blobs are
+    hard-linked (or copied if that fails) wherever needed. The least recently used blobs are evicted once the store
+    grows past its size limit.
+    """
+
+    def __init__(self, root, limit):
+
+        self.limit = limit
+        self.lock = Lock()
+        self.root = root
+        self.used = {}
+
+        #
+        # - pick up whatever blob we have from a previous run (the mtime tells when it was last used)
+        # - wipe any partial upload
+        #
+        if not isdir(root):
+            os.makedirs(root)
+
+        for name in os.listdir(root):
+            path = join(root, name)
+            if _SHA1.match(name):
+                stat = os.stat(path)
+                self.used[name] = [stat.st_size, stat.st_mtime]
+            else:
+                os.remove(path)
+
+    def missing(self, digests):
+
+        with self.lock:
+            return [digest for digest in digests if digest not in self.used]
+
+    def put(self, digest, stream):
+
+        assert _SHA1.match(digest), 'invalid SHA1'
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+
+            #
+            # - hash as we write
+            # - the blob is made read-only (it will be shared via hard-links)
+            #
+            size = 0
+            sha1 = hashlib.sha1()
+            with os.fdopen(fd, 'wb') as f:
+                while 1:
+                    chunk = stream.read(65536)
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            assert sha1.hexdigest() == digest, 'SHA1 mismatch (corrupted upload ?)'
+            os.chmod(tmp, 0444)
+            os.rename(tmp, join(self.root, digest))
+
+        except Exception:
+
+            os.remove(tmp)
+            raise
+
+        with self.lock:
+            self.used[digest] = [size, time.time()]
+            self._evict(digest)
+
+        return size
+
+    def link(self, digest, where):
+
+        with self.lock:
+            if digest not in self.used:
+                return False
+
+            #
+            # - touch the blob (we rely on the mtime to restore the LRU order upon restart)
+            # - hard-link it, copy it if we can't
+            #
+            path = join(self.root, digest)
+            now = time.time()
+            self.used[digest][1] = now
+            os.utime(path, (now, now))
+            try:
+                os.link(path, where)
+
+            except OSError:
+
+                shutil.copyfile(path, where)
+
+            return True
+
+    def _evict(self, keep):
+
+        #
+        # - evict the least recently used blobs until we fit (the lock must be held)
+        # - the blob we just stored is spared
+        #
+        total = sum(size for size, _ in self.used.values())
+        for digest in sorted(self.used, key=lambda d: self.used[d][1]):
+            if total <= self.limit:
+                break
+
+            if digest != keep:
+                total -= self.used.pop(digest)[0]
+                try:
+                    os.remove(join(self.root, digest))
+
+                except OSError:
+                    pass
+
+
+class _Missing(AssertionError):
+    """
+    Raised when a command references blobs our store does not have. This happens when several portals run behind
+    one address (each one has its own store) and the upload went to another one : the CLI then re-sends the files
+    as a multi-part upload.
+    """
+
+    def __init__(self, digests):
+        AssertionError.__init__(self, 'blobs %s are missing (upload them first)' % ', '.join(digests))
+
+        self.digests = digests
+
+
+class _Cache(object):
+    """
+    TTL cache holding the output of read-only commands, keyed by normalized command line. An entry is also considered
+    stale as soon as the registry generation it was computed at changes (e.g some pod registered, updated its hints
+    or went away) or once invalidate() is called.
+    """
+
+    def __init__(self, ttl, size=256):
+
+        self.entries = {}
+        self.epoch = 0
+        self.lock = Lock()
+        self.size = size
+        self.ttl = ttl
+
+    def stamp(self):
+        """
+        Returns the stamp to pass to put() for an output computed from now on.
+        """
+
+        return generation(), self.epoch
+
+    def invalidate(self):
+
+        with self.lock:
+            self.entries.clear()
+            self.epoch += 1
+
+    def get(self, key):
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        ts, stamp, lines, code = entry
+        if time.time() - ts > self.ttl or stamp != self.stamp():
+            return None
+
+        return lines, code
+
+    def put(self, key, stamp, lines, code):
+
+        if self.ttl <= 0:
+            return
+
+        with self.lock:
+
+            #
+            # - make room if needed by evicting the oldest entries
+            #
+            now = time.time()
+            if len(self.entries) >= self.size:
+                for stale in sorted(self.entries, key=lambda k: self.entries[k][0])[:1 + self.size / 4]:
+                    del self.entries[stale]
+
+            self.entries[key] = (now, stamp, lines, code)
+
+
+class _Tee(object):
+    """
+    Output sink duplicating whatever lines it is fed.
+    """
+
+    def __init__(self, *sinks):
+
+        self.sinks = sinks
+
+    def extend(self, lines):
+
+        for sink in self.sinks:
+            sink.extend(lines)
+
+
+class _Flight(object):
+    """
+    Command running on behalf of one request which identical concurrent requests can attach to. Its output is
+    retained until it completes so that requests attaching late still get all of it.
+    """
+
+    def __init__(self):
+
+        self.code = None
+        self.condition = Condition()
+        self.done = False
+        self.lines = []
+
+    def extend(self, lines):
+
+        with self.condition:
+            self.lines.extend(lines)
+            self.condition.notify_all()
+
+    def close(self, code):
+
+        with self.condition:
+            self.code = code
+            self.done = True
+            self.condition.notify_all()
+
+    def follow(self, out):
+        """
+        Relays the output lines to the specified sink as they come and returns the exit code once done.
+        """
+
+        n = 0
+        while 1:
+            with self.condition:
+                while n == len(self.lines) and not self.done:
+                    self.condition.wait()
+
+                batch = self.lines[n:]
+                n += len(batch)
+                done = self.done
+
+            if batch:
+                out.extend(batch)
+
+            if done:
+                return self.code
+
+
+class _Job(object):
+    """
+    Command line run asynchronously on behalf of a POST /jobs. Its output lines are retained until the job expires
+    so that they can be fetched incrementally.
+    """
+
+    def __init__(self, line):
+
+        self.code = None
+        self.finished = None
+        self.id = str(uuid.uuid4())
+        self.line = line
+        self.out = []
+        self.started = None
+        self.state = 'queued'
+        self.submitted = time.time()
+
+    def start(self):
+
+        self.started = time.time()
+        self.state = 'running'
+
+    def close(self, code):
+
+        self.code = code
+        self.finished = time.time()
+        self.state = 'done'
+
+    def describe(self, since=0):
+
+        #
+        # - only return the output lines past the specified index
+        # - 'next' is what the client should pass as ?since= in its next poll
+        #
+        lines = self.out[since:]
+        js = \
+            {
+                'id': self.id,
+                'line': self.line,
+                'state': self.state,
+                'out': lines,
+                'next': since + len(lines)
+            }
+
+        if self.state == 'done':
+            js['ok'] = self.code == 0
+            js['code'] = self.code
+            js['ms'] = 1000 * (self.finished - self.started)
+
+        return js
+
 
 if __name__ == '__main__':
 
@@ -43,64 +373,379 @@ if __name__ == '__main__':
         # - parse our ochopod hints
         # - enable CLI logging
         # - pass down the ZK ensemble coordinate as $OCHOPOD_ZK (all tools use that to perform their queries)
+        # - attach a long-lived zookeeper session (re-connected automatically) that tools running in-process will
+        #   share instead of connecting each time
+        # - its watch-backed registry can be turned off by setting $OCHOPOD_REGISTRY to 'false'
         #
         env = os.environ
         hints = json.loads(env['ochopod'])
         ochopod.enable_cli_log(debug=hints['debug'] == 'true')
         env['OCHOPOD_ZK'] = hints['zk']
+        registry = env.get('OCHOPOD_REGISTRY', 'true').lower() == 'true'
+        session = attach([node for node in hints['zk'].split(',')], registry=registry)
+
+        #
+        # - scan & import the tools once and for all
+        # - $OCHOPOD_INPROCESS can be set to 'false' to fork a 'toolset' sub-process for each request instead
+        # - keep the console handlers from echoing what the in-process commands output (it goes back to the caller)
+        #
+        tools = load()
+        uncaptured(logger, logging.getLogger())
+        inprocess = env.get('OCHOPOD_INPROCESS', 'true').lower() == 'true'
+
+        #
+        # - the output of read-only commands is cached for $OCHOPOD_CACHE_TTL seconds (2 by default, 0 disables it)
+        # - any change to the pod znodes invalidates the whole cache (as seen by the registry, if enabled)
+        # - so does any other command we run (e.g deploy or kill), whether the registry is enabled or not
+        # - the list of cached commands can be changed via $OCHOPOD_CACHE_COMMANDS
+        #
+        cached = env.get('OCHOPOD_CACHE_COMMANDS', 'ls grep port poll').split()
+        cache = _Cache(float(env.get('OCHOPOD_CACHE_TTL', 2.0)))
+
+        #
+        # - concurrent requests for the same read-only command share one single execution
+        #
+        guard = Lock()
+        inflight = {}
+
+        #
+        # - the files uploaded by the CLI are kept in a content-addressed store and hard-linked into the
+        #   temporary directory of each command using them
+        # - the store sits in our temporary directory (hard-links require the same filesystem)
+        # - it is capped to $OCHOPOD_BLOBS_MB megabytes (256 by default), the least recently used blobs are evicted
+        #
+        blobs = _Blobs(join(tempfile.gettempdir(), 'blobs'), int(env.get('OCHOPOD_BLOBS_MB', 256)) * 1024 * 1024)
+
+        #
+        # - the timelines recorded by commands run with --trace are returned with the reply and also kept locally
+        # - we retain the last $OCHOPOD_TRACES (32 by default)
+        #
+        traces = join(tempfile.gettempdir(), 'traces')
+        retained = int(env.get('OCHOPOD_TRACES', 32))
+        if not isdir(traces):
+            os.makedirs(traces)
+
+        #
+        # - this event is set upon SIGTERM, at which point we stop accepting new commands
+        #
+        draining = Event()
+
+        @web.route('/metrics', methods=['GET'])
+        def _metrics():
+
+            #
+            # - dump our metrics in the prometheus text format
+            # - please note the toolset metrics (lookups, fan-outs, etc.) only cover the commands run in-process
+            #
+            return render(), 200, \
+                {
+                    'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+                }
+
+        @web.route('/health', methods=['GET'])
+        def _health():
+
+            #
+            # - report the state of our shared zookeeper session
+            # - reply with a HTTP 503 if we are currently disconnected or shutting down
+            #
+            js = {'zk': session.health(), 'draining': draining.is_set()}
+            return json.dumps(js), 200 if js['zk']['connected'] and not js['draining'] else 503, \
+                {
+                    'Content-Type': 'application/json; charset=utf-8'
+                }
+
+        def _spawn(line, tokens, local, tmp, out):
+
+            #
+            # - run the command line in-process using the tools we pre-loaded (and our shared zookeeper session)
+            # - otherwise use the 'toolset' python package that's installed in the container
+            # - in both cases the output lines are appended to out (either a list or an Output)
+            # - the debug output is emitted by multiple threads and the tracer is process-wide : a command turning
+            #   either on bails out before running (see Isolated), in which case we fork a sub-process instead
+            # - return how the command was run plus its exit code
+            #
+            if local:
+                try:
+                    return 'in-process', execute(tokens, out)
+
+                except Isolated:
+
+                    logger.debug('http -> "%s" needs a sub-process' % line)
+
+            ts = time.time()
+            spawned = 0
+            pid = Popen('toolset %s' % line, shell=True, stdout=PIPE, stderr=None, env=env, cwd=tmp)
+
+            #
+            # - pipe the process stdout
+            # - the spawn latency runs until the first line comes in (or until the process exits)
+            #
+            while 1:
+                code = pid.poll()
+                raw = pid.stdout.readline()
+                if not spawned:
+                    spawned = 1
+                    SPAWN_SECONDS.observe(time.time() - ts)
+
+                if not raw and code is not None:
+                    break
+                elif raw:
+                    out.extend([raw.rstrip('\n')])
+
+            return 'sub-process', pid.returncode
+
+        def _timeline(tokens, tmp, ts):
+
+            #
+            # - load the timeline the tool dumped in its working directory (if any, e.g it was run with --trace)
+            # - prepend the portal side of the request (the gap until the first tool span is the spawn cost)
+            # - save it as <time>-<tool>.json in our traces directory
+            #
+            path = join(tmp, trace.FILE)
+            if not exists(path):
+                return None
+
+            with open(path, 'rb') as f:
+                events = json.loads(f.read())['traceEvents']
+
+            portal = \
+                {
+                    'name': 'shell',
+                    'cat': 'portal',
+                    'ph': 'X',
+                    'ts': int(ts * 1000000),
+                    'dur': int((time.time() - ts) * 1000000),
+                    'pid': os.getpid(),
+                    'tid': 0,
+                    'args': {'line': ' '.join(tokens)}
+                }
+
+            events.insert(0, portal)
+            saved = join(traces, '%d-%s.json' % (int(ts * 1000), tokens[0]))
+            with open(saved, 'wb') as f:
+                f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+            for name in sorted(os.listdir(traces))[:-retained]:
+                os.remove(join(traces, name))
+
+            logger.debug('http -> trace saved @ %s (%d events)' % (saved, len(events)))
+            return events
+
+        def _prepare(tmp):
+
+            #
+            # - retrieve the command line
+            #
+            assert 'X-Shell' in request.headers, 'X-Shell header missing'
+            line = request.headers['X-Shell']
+
+            #
+            # - compute the incoming command line HMAC and compare (use our pod token as the key)
+            #
+            if 'token' in os.environ and os.environ['token']:
+                assert 'X-Signature' in request.headers, 'signature missing (make sure you define $OCHOPOD_TOKEN)'
+                digest = 'sha1=' + hmac.new(os.environ['token'], line, hashlib.sha1).hexdigest()
+                assert digest == request.headers['X-Signature'], 'SHA1 signature mismatch (check your token)'
+
+            #
+            # - download each multi-part file to a temporary folder
+            #
+            for tag, upload in request.files.items():
+                where = join(tmp, tag)
+                logger.debug('http -> upload @ %s' % where)
+                upload.save(where)
+
+            #
+            # - materialize whatever blob is listed in X-Blobs (comma separated <tag>=<sha1> pairs)
+            # - the CLI uploads them beforehand via PUT /blobs/<sha1>
+            # - the upload may have reached another portal : report whatever we don't have at once
+            #
+            linked = 0
+            missing = []
+            for pair in request.headers.get('X-Blobs', '').split(','):
+                tag, _, digest = pair.strip().partition('=')
+                if tag:
+                    assert tag == basename(tag) and tag not in ['.', '..'], 'invalid blob tag "%s"' % tag
+                    if not blobs.link(digest, join(tmp, tag)):
+                        missing.append(digest)
+                    linked += 1
+
+            if missing:
+                raise _Missing(missing)
+
+            #
+            # - get the shell snippet to run from the X-Shell header
+            # - we'll run it in-process unless files were provided (the tools expect them in their working
+            #   directory)
+            # - commands run with -d or --trace are switched to a sub-process once parsed (see _spawn())
+            # - read-only commands (without uploads) can be served from our cache, in which case their normalized
+            #   command line is used as the cache key
+            #
+            logger.debug('http -> shell request "%s"' % line)
+            tokens = shlex.split(line.encode('utf-8') if isinstance(line, unicode) else line)
+            plain = not request.files and not linked
+            local = inprocess and plain
+            key = ' '.join(tokens) if plain and tokens and tokens[0] in cached else None
+            return line, tokens, local, key
+
+        def _run(line, tokens, local, key, tmp, out):
+
+            #
+            # - time the command and label it by tool (anything we don't know is reported as 'unknown')
+            #
+            ts = time.time()
+            mode = 'in-process' if local else 'sub-process'
+            command = tokens[0] if tokens and tokens[0] in tools else 'unknown'
+            code = 1
+            try:
+                mode, code = _serve(line, tokens, local, key, tmp, out)
+                return code
+
+            finally:
+
+                #
+                # - anything but a read-only command may have changed the pods : drop our cached outputs
+                #
+                if not tokens or tokens[0] not in cached:
+                    cache.invalidate()
+
+                COMMAND_SECONDS.observe(time.time() - ts, command=command, mode=mode)
+                if code != 0:
+                    COMMAND_FAILURES.inc(command=command)
+
+        def _serve(line, tokens, local, key, tmp, out):
+
+            #
+            # - serve from the cache if possible
+            # - otherwise run the command and cache its output if it succeeded
+            # - the output of commands switched to a sub-process (-d or --trace) is not cached
+            # - grab the cache stamp upfront (any change while running will invalidate the entry)
+            # - return how we ended up serving the command plus its exit code
+            #
+            if key is None:
+                return _spawn(line, tokens, local, tmp, out)
+
+            hit = cache.get(key)
+            if hit is not None:
+                lines, code = hit
+                out.extend(lines)
+                return 'cache', code
+
+            #
+            # - if the very same command is already running attach to it and relay its output
+            # - otherwise run it ourselves and let others attach
+            #
+            with guard:
+                flight = inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = _Flight()
+                    inflight[key] = flight
+
+            if not leader:
+                logger.debug('http -> attaching to in-flight "%s"' % key)
+                return 'coalesced', flight.follow(out)
+
+            code = 1
+            mode = 'in-process' if local else 'sub-process'
+            stamp = cache.stamp()
+            try:
+                mode, code = _spawn(line, tokens, local, tmp, _Tee(out, flight))
+                if code == 0 and (mode == 'in-process' or not local):
+                    cache.put(key, stamp, flight.lines, code)
+
+            finally:
+
+                with guard:
+                    del inflight[key]
+
+                flight.close(code)
+
+            return mode, code
 
         @web.route('/shell', methods=['POST'])
         def _from_curl():
 
+            if draining.is_set():
+                return json.dumps({'ok': False, 'ms': 0, 'out': 'failure -> the portal is shutting down'}), 503, \
+                    {
+                        'Content-Type': 'application/json; charset=utf-8'
+                    }
+
             out = []
             ok = False
             ts = time.time()
+            events = None
+            missing = None
             tmp = tempfile.mkdtemp()
+            streamed = request.headers.get('X-Stream', '').lower() == 'true'
             try:
 
-                #
-                # - retrieve the command line
-                #
-                assert 'X-Shell' in request.headers, 'X-Shell header missing'
-                line = request.headers['X-Shell']
+                line, tokens, local, key = _prepare(tmp)
+                if streamed:
 
-                #
-                # - compute the incoming command line HMAC and compare (use our pod token as the key)
-                #
-                if 'token' in os.environ and os.environ['token']:
-                    assert 'X-Signature' in request.headers, 'signature missing (make sure you define $OCHOPOD_TOKEN)'
-                    digest = 'sha1=' + hmac.new(os.environ['token'], line, hashlib.sha1).hexdigest()
-                    assert digest == request.headers['X-Signature'], 'SHA1 signature mismatch (check your token)'
+                    #
+                    # - streaming mode (X-Stream set to true)
+                    # - run the command from a separate thread which owns the temporary directory from now on
+                    # - reply right away with chunks, one json object per line ({"line": ...} for each output line
+                    #   followed by a final {"ok": ..., "ms": ...})
+                    #
+                    output = Output()
+                    timeline = {}
 
-                #
-                # - download each multi-part file to a temporary folder
-                #
-                for tag, upload in request.files.items():
-                    where = join(tmp, tag)
-                    logger.debug('http -> upload @ %s' % where)
-                    upload.save(where)
+                    def _background(where):
+                        code = 1
+                        try:
+                            code = _run(line, tokens, local, key, where, output)
+                            timeline['events'] = _timeline(tokens, where, ts)
 
-                #
-                # - get the shell snippet to run from the X-Shell header
-                # - use the 'toolset' python package that's installed in the container
-                # - open it
-                #
-                logger.debug('http -> shell request "%s"' % line)
-                pid = Popen('toolset %s' % line, shell=True, stdout=PIPE, stderr=None, env=env, cwd=tmp)
+                        except Exception as failure:
+
+                            output.extend(['unexpected failure -> %s' % diagnostic(failure)])
+
+                        finally:
+
+                            shutil.rmtree(where)
+                            output.close(code)
+
+                    thread = Thread(target=_background, args=(tmp,))
+                    thread.daemon = True
+                    thread.start()
+                    tmp = None
+
+                    def _chunks():
+                        try:
+                            for text in output.drain():
+                                yield json.dumps({'line': text}) + '\n'
+
+                            js = {'ok': output.code == 0, 'ms': 1000 * (time.time() - ts)}
+                            if timeline.get('events'):
+                                js['trace'] = timeline['events']
+
+                            yield json.dumps(js) + '\n'
+
+                        except GeneratorExit:
+
+                            #
+                            # - the client went away, the command keeps on running in the background
+                            # - make sure its output does not pile up in memory
+                            #
+                            output.discard()
+                            raise
+
+                    return Response(_chunks(), mimetype='application/x-ndjson')
 
                 #
-                # - pipe the process stdout
-                # - return as json ('out' contains the verbatim dump from the sub-process stdout)
+                # - return as json ('out' contains the verbatim dump from the tool)
                 #
-                while 1:
-                    code = pid.poll()
-                    line = pid.stdout.readline()
-                    if not line and code is not None:
-                        break
-                    elif line:
-                        out += [line.rstrip('\n')]
+                ok = _run(line, tokens, local, key, tmp, out) == 0
+                events = _timeline(tokens, tmp, ts)
 
-                ok = pid.returncode == 0
+            except _Missing as failure:
+
+                missing = failure.digests
+                out = ['failure -> %s' % failure]
 
             except AssertionError as failure:
 
@@ -113,11 +758,23 @@ if __name__ == '__main__':
             finally:
 
                 #
-                # - make sure to cleanup our temporary directory
+                # - make sure to cleanup our temporary directory (unless the streaming thread took it over)
                 #
-                shutil.rmtree(tmp)
+                if tmp is not None:
+                    shutil.rmtree(tmp)
 
             ms = 1000 * (time.time() - ts)
+            if streamed and missing is None:
+
+                #
+                # - we failed before streaming anything, send the failure back as chunks anyway
+                #
+                chunks = [json.dumps({'line': text}) for text in out] + [json.dumps({'ok': ok, 'ms': ms})]
+                return '\n'.join(chunks) + '\n', 200, \
+                    {
+                        'Content-Type': 'application/x-ndjson'
+                    }
+
             js = \
                 {
                     'ok': ok,
@@ -125,15 +782,283 @@ if __name__ == '__main__':
                     'out': '\n'.join(out)
                 }
 
+            #
+            # - list the blobs we don't have so that the CLI can re-send them as a multi-part upload
+            # - this is sent as one single json object, streamed or not
+            #
+            if missing is not None:
+                js['missing'] = missing
+
+            if events:
+                js['trace'] = events
+
             return json.dumps(js), 200, \
                 {
                     'Content-Type': 'application/json; charset=utf-8'
                 }
 
+        #
+        # - asynchronous jobs are run on a bounded pool of threads
+        # - $OCHOPOD_JOBS is the number of jobs allowed to run concurrently (8 by default)
+        # - $OCHOPOD_JOBS_BACKLOG caps how many jobs can wait for a thread (64 by default)
+        # - $OCHOPOD_JOBS_TTL is how long (in seconds) a finished job is retained (10 minutes by default)
+        #
+        jobs = {}
+        lock = Lock()
+        workers = Pool(int(env.get('OCHOPOD_JOBS', 8)))
+        backlog = int(env.get('OCHOPOD_JOBS_BACKLOG', 64))
+        ttl = float(env.get('OCHOPOD_JOBS_TTL', 600))
+
+        #
+        # - several portals may run behind the same address (see dcos.json)
+        # - each job is registered in zookeeper as an ephemeral znode holding the address of the portal running it
+        # - any portal can then relay GET /jobs/<id> to the job owner
+        #
+        owner = '%s:%s' % (hints.get('ip', socket.gethostname()), hints.get('ports', {}).get('9000', 9000))
+
+        def _expire():
+
+            #
+            # - lazily drop whatever finished job is past its TTL
+            # - the lock must be held, returns the identifiers of the jobs that got dropped
+            #
+            now = time.time()
+            expired = [key for key, job in jobs.items() if job.finished and now - job.finished > ttl]
+            for key in expired:
+                del jobs[key]
+
+            return expired
+
+        def _forget(expired):
+
+            #
+            # - unregister the expired jobs (fire & forget)
+            #
+            def _delete(zk):
+                for key in expired:
+                    zk.delete_async('%s/%s' % (JOBS, key))
+
+            if expired:
+                try:
+                    run(session.proxy, _delete, timeout=5.0)
+
+                except Exception as failure:
+
+                    logger.debug('http -> unable to unregister %d jobs (%s)' % (len(expired), failure))
+
+        def _reply(js, code):
+            return json.dumps(js), code, \
+                {
+                    'Content-Type': 'application/json; charset=utf-8'
+                }
+
+        @web.route('/blobs', methods=['POST'])
+        def _check():
+
+            #
+            # - the payload is {"hashes": [...]}
+            # - reply with the list of the blobs we don't have
+            #
+            try:
+                js = json.loads(request.get_data())
+                return _reply({'ok': True, 'missing': blobs.missing(js['hashes'])}, 200)
+
+            except (KeyError, TypeError, ValueError):
+
+                return _reply({'ok': False, 'out': 'invalid payload (expecting {"hashes": [...]})'}, 400)
+
+        @web.route('/blobs/<digest>', methods=['PUT'])
+        def _upload(digest):
+
+            try:
+
+                #
+                # - the signature (if any) is computed over the SHA1
+                # - stream the body to the store (the SHA1 is checked on the fly)
+                #
+                if 'token' in os.environ and os.environ['token']:
+                    signature = 'sha1=' + hmac.new(os.environ['token'], digest, hashlib.sha1).hexdigest()
+                    assert signature == request.headers.get('X-Signature'), 'SHA1 signature mismatch (check your token)'
+
+                size = blobs.put(digest, request.stream)
+                logger.debug('http -> blob %s stored (%d bytes)' % (digest, size))
+                return _reply({'ok': True}, 200)
+
+            except AssertionError as failure:
+
+                return _reply({'ok': False, 'out': 'failure -> %s' % failure}, 400)
+
+            except Exception as failure:
+
+                return _reply({'ok': False, 'out': 'unexpected failure -> %s' % diagnostic(failure)}, 500)
+
+        @web.route('/jobs', methods=['POST'])
+        def _submit():
+
+            if draining.is_set():
+                return _reply({'ok': False, 'out': 'the portal is shutting down'}, 503)
+
+            tmp = tempfile.mkdtemp()
+            try:
+
+                #
+                # - same headers & uploads as /shell
+                # - reply with a HTTP 503 if too many jobs are already queued
+                #
+                line, tokens, local, key = _prepare(tmp)
+                with lock:
+                    expired = _expire()
+                    queued = sum(1 for job in jobs.values() if job.state == 'queued')
+                    if queued < backlog:
+                        job = _Job(line)
+                        jobs[job.id] = job
+
+                _forget(expired)
+                if queued >= backlog:
+                    return _reply({'ok': False, 'out': 'too many jobs queued (retry later)'}, 503)
+
+                #
+                # - register the job before running it so that other portals can relay to us
+                # - if zookeeper is not reachable the job will only be visible from this portal
+                #
+                path = '%s/%s' % (JOBS, job.id)
+                try:
+                    run(session.proxy, lambda zk: zk.create(path, owner, ephemeral=True, makepath=True), timeout=5.0)
+
+                except Exception as failure:
+
+                    logger.warning('http -> unable to register job %s (%s)' % (job.id, failure))
+
+                def _background(where):
+                    code = 1
+                    job.start()
+                    try:
+                        code = _run(line, tokens, local, key, where, job.out)
+
+                    except Exception as failure:
+
+                        job.out.append('unexpected failure -> %s' % diagnostic(failure))
+
+                    finally:
+
+                        shutil.rmtree(where)
+                        job.close(code)
+
+                #
+                # - the job owns the temporary directory from now on
+                # - reply right away with the job identifier
+                #
+                workers.submit(_background, tmp)
+                tmp = None
+                logger.debug('http -> job %s queued ("%s")' % (job.id, line))
+                return _reply({'ok': True, 'id': job.id}, 202)
+
+            except _Missing as failure:
+
+                return _reply({'ok': False, 'out': 'failure -> %s' % failure, 'missing': failure.digests}, 409)
+
+            except AssertionError as failure:
+
+                return _reply({'ok': False, 'out': 'failure -> %s' % failure}, 400)
+
+            except Exception as failure:
+
+                return _reply({'ok': False, 'out': 'unexpected failure -> %s' % diagnostic(failure)}, 500)
+
+            finally:
+
+                if tmp is not None:
+                    shutil.rmtree(tmp)
+
+        @web.route('/jobs/<key>', methods=['GET'])
+        def _status(key):
+
+            #
+            # - return the job state plus its output lines (starting at ?since= if specified)
+            # - the exit code is included once the job is done
+            #
+            with lock:
+                expired = _expire()
+                job = jobs.get(key)
+
+            _forget(expired)
+            if job is None and 'X-Relayed' not in request.headers:
+
+                #
+                # - the job may be owned by another portal, in which case relay the request to it
+                #
+                try:
+                    where, _ = run(session.proxy, lambda zk: zk.get('%s/%s' % (JOBS, key)), timeout=5.0)
+                    if where != owner:
+                        url = 'http://%s/jobs/%s' % (where, key)
+                        reply = requests.get(url, params=request.args, headers={'X-Relayed': owner}, timeout=10.0)
+                        logger.debug('http -> job %s relayed to %s (HTTP %d)' % (key, where, reply.status_code))
+                        return reply.content, reply.status_code, \
+                            {
+                                'Content-Type': 'application/json; charset=utf-8'
+                            }
+
+                except Exception as failure:
+
+                    logger.debug('http -> unable to locate job %s (%s)' % (key, failure))
+
+            if job is None:
+                return _reply({'ok': False, 'out': 'unknown job (expired ?)'}, 404)
+
+            return _reply(job.describe(max(0, request.args.get('since', 0, type=int))), 200)
+
         #
         # - run our flask endpoint on TCP 9000
+        # - $OCHOPOD_SERVER can be set to 'werkzeug' to use the flask development server (one thread per connection)
+        # - otherwise use cheroot (a bounded pool of $OCHOPOD_THREADS threads with keep-alive)
+        # - we stick to threads (as opposed to pre-forked workers) since the zookeeper session and the jobs live in
+        #   memory and must be shared by all requests
         #
-        web.run(host='0.0.0.0', port=9000, threaded=True)
+        if env.get('OCHOPOD_SERVER', 'cheroot') == 'werkzeug':
+            web.run(host='0.0.0.0', port=9000, threaded=True)
+
+        else:
+
+            #
+            # - $OCHOPOD_QUEUE caps how many accepted connections can wait for a thread (any connection past that is
+            #   dropped)
+            # - $OCHOPOD_KEEPALIVE is the idle timeout in seconds for keep-alive connections
+            # - $OCHOPOD_GRACE is how long in seconds we wait for in-flight requests & jobs upon SIGTERM
+            #
+            grace = float(env.get('OCHOPOD_GRACE', 30))
+            server = Server(
+                ('0.0.0.0', 9000),
+                web,
+                numthreads=int(env.get('OCHOPOD_THREADS', 32)),
+                request_queue_size=128,
+                timeout=int(env.get('OCHOPOD_KEEPALIVE', 15)),
+                shutdown_timeout=grace,
+                accepted_queue_size=int(env.get('OCHOPOD_QUEUE', 128)),
+                accepted_queue_timeout=1)
+
+            def _drain():
+
+                #
+                # - refuse new commands (HTTP 503) and give the running jobs a chance to complete
+                # - then stop the server (which will wait for the in-flight requests)
+                #
+                draining.set()
+                deadline = time.time() + grace
+                while time.time() < deadline and any(job.state != 'done' for job in jobs.values()):
+                    time.sleep(0.25)
+
+                logger.info('drained, stopping the server')
+                server.stop()
+
+            def _on_sigterm(*_):
+                if not draining.is_set():
+                    logger.info('SIGTERM received, draining (%d seconds at most)' % grace)
+                    thread = Thread(target=_drain)
+                    thread.daemon = True
+                    thread.start()
+
+            signal.signal(signal.SIGTERM, _on_sigterm)
+            server.start()
 
     except Exception as failure:
 
@@ -141,4 +1066,8 @@ if __name__ == '__main__':
 
     finally:
 
+        #
+        # - tear our zookeeper session down (its actor would otherwise keep us alive)
+        #
+        detach()
         sys.exit(1)
\ No newline at end of file
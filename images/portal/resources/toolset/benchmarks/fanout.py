@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmark comparing the 'threads' and 'events' fan-out engines from toolset.io against simulated pods. The pods
+are emulated by a separate process listening on a few local ports and answering each POST /info after a fixed
+latency. For instance:
+
+ $ python benchmarks/fanout.py -n 100 1000 10000 -l 50
+ pods    |  engine   |  replies  |  wall (ms)  |  threads
+         |           |           |             |
+ 100     |  threads  |  100      |  264        |  64
+ 100     |  events   |  100      |  99         |  1
+ ...
+
+Please note the 10,000 pods run requires a large enough file descriptor limit (the script attempts to raise it).
+"""
+
+import heapq
+import json
+import logging
+import resource
+import select
+import socket
+import sys
+import time
+
+from argparse import ArgumentParser
+from multiprocessing import Event, Process
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+
+def _unlimit():
+
+    #
+    # - raise our file descriptor limit as much as we can
+    #
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    except ValueError:
+        pass
+
+
+def _pods(ports, latency, ready):
+    """
+    Simulated pods : epoll based server replying to any POST with a small json payload after the specified
+    latency (in seconds).
+    """
+
+    _unlimit()
+    poller = select.epoll()
+    listeners = {}
+    for port in ports:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', port))
+        sock.listen(4096)
+        sock.setblocking(0)
+        listeners[sock.fileno()] = sock
+        poller.register(sock.fileno(), select.EPOLLIN)
+
+    ready.set()
+    body = json.dumps({'process': 'running', 'state': 'follower'})
+    reply = 'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+    buffers = {}
+    conns = {}
+    timers = []
+    while 1:
+        now = time.time()
+        while timers and timers[0][0] <= now:
+            _, fd = heapq.heappop(timers)
+            sock = conns.pop(fd)
+            try:
+                sock.sendall(reply)
+
+            except socket.error:
+                pass
+
+            sock.close()
+
+        lapse = max(0.0, timers[0][0] - now) if timers else 1.0
+        for fd, _ in poller.poll(lapse):
+            if fd in listeners:
+                try:
+                    while 1:
+                        sock, _ = listeners[fd].accept()
+                        sock.setblocking(0)
+                        conns[sock.fileno()] = sock
+                        buffers[sock.fileno()] = ''
+                        poller.register(sock.fileno(), select.EPOLLIN)
+
+                except socket.error:
+                    pass
+
+            elif fd in buffers:
+                try:
+                    chunk = conns[fd].recv(65536)
+
+                except socket.error:
+                    continue
+
+                buffers[fd] += chunk
+                head, sep, rest = buffers[fd].partition('\r\n\r\n')
+                length = [int(line.split(':')[1]) for line in head.split('\r\n') if line.lower().startswith('content-length')]
+                if not chunk or (sep and len(rest) >= (length[0] if length else 0)):
+
+                    #
+                    # - we have the whole request, schedule the reply
+                    #
+                    del buffers[fd]
+                    poller.unregister(fd)
+                    heapq.heappush(timers, (time.time() + latency, fd))
+
+
+def _run(n, engine, ports, timeout):
+
+    from toolset.io import fanout, scatter
+
+    pods = {}
+    for seq in range(n):
+        port = ports[seq % len(ports)]
+        pods['simulated #%d' % seq] = \
+            {
+                'seq': seq,
+                'ip': '127.0.0.1',
+                'port': '8080',
+                'ports': {'8080': port}
+            }
+
+    ts = time.time()
+    out = list(scatter(pods, 'info', timeout=timeout, engine=engine))
+    ms = 1000 * (time.time() - ts)
+    return \
+        {
+            'pods': n,
+            'engine': engine,
+            'replies': sum(1 for _, _, _, code, _ in out if code == 200),
+            'ms': int(ms),
+            'threads': len(fanout.threads) if engine == 'threads' else 1
+        }
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='fan-out engine benchmark')
+    parser.add_argument('-n', action='store', dest='pods', type=int, nargs='+', default=[100, 1000, 10000], help='number of simulated pods')
+    parser.add_argument('-l', action='store', dest='latency', type=float, default=50, help='simulated pod latency in ms')
+    parser.add_argument('-p', action='store', dest='ports', type=int, default=64, help='number of listening ports')
+    parser.add_argument('-r', action='store', dest='rounds', type=int, default=3, help='rounds per configuration')
+    parser.add_argument('-t', action='store', dest='timeout', type=float, default=30.0, help='per-query timeout in seconds')
+    parser.add_argument('-j', action='store_true', dest='json', help='json output')
+    args = parser.parse_args()
+
+    _unlimit()
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+    logging.getLogger('requests.packages.urllib3').setLevel(logging.ERROR)
+
+    ports = range(20000, 20000 + args.ports)
+    ready = Event()
+    server = Process(target=_pods, args=(ports, args.latency / 1000.0, ready))
+    server.daemon = True
+    server.start()
+    ready.wait()
+
+    try:
+
+        #
+        # - run each configuration a few times and keep the best run
+        #
+        results = []
+        for n in args.pods:
+            for engine in ['threads', 'events']:
+                runs = [_run(n, engine, ports, args.timeout) for _ in range(args.rounds)]
+                results.append(min(runs, key=lambda js: js['ms']))
+
+        if args.json:
+            print(json.dumps(results))
+
+        else:
+            rows = [['pods', '|', 'engine', '|', 'replies', '|', 'wall (ms)', '|', 'threads'], ['', '|', '', '|', '', '|', '', '|', '']]
+            rows += [[str(js['pods']), '|', js['engine'], '|', str(js['replies']), '|', str(js['ms']), '|', str(js['threads'])] for js in results]
+            widths = [max(map(len, col)) for col in zip(*rows)]
+            for row in rows:
+                print('  '.join((val.ljust(width) for val, width in zip(row, widths))))
+
+    finally:
+
+        server.terminate()
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Micro-benchmark measuring the round-trip latency of toolset.io.run() (e.g the time it takes for the zookeeper
+proxy actor to pick a closure up, run it and hand the result back). The closure does nothing, which isolates the
+dispatching overhead. The zookeeper ensemble is specified via $OCHOPOD_ZK or -z. For instance:
+
+ $ python benchmarks/proxy.py -z 10.0.0.1:2181 -n 100
+ 100 calls -> mean 0.21 ms, p50 0.18 ms, p99 0.62 ms, max 0.70 ms
+"""
+
+import json
+import os
+import sys
+import time
+
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from ochopod.core.fsm import shutdown
+from toolset.io import run, ZK
+
+
+def _measure(proxy, n):
+
+    #
+    # - the first call absorbs the connection setup
+    #
+    run(proxy, lambda zk: None)
+    lapses = []
+    for _ in range(n):
+        ts = time.time()
+        run(proxy, lambda zk: None)
+        lapses.append(1000 * (time.time() - ts))
+
+    lapses.sort()
+    return \
+        {
+            'calls': n,
+            'mean': sum(lapses) / n,
+            'p50': lapses[n / 2],
+            'p99': lapses[min(n - 1, int(n * 0.99))],
+            'max': lapses[-1]
+        }
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='zookeeper proxy round-trip benchmark')
+    parser.add_argument('-n', action='store', dest='calls', type=int, default=100, help='number of run() calls')
+    parser.add_argument('-z', action='store', dest='zk', type=str, default=os.environ.get('OCHOPOD_ZK', ''), help='zookeeper ensemble')
+    parser.add_argument('-j', action='store_true', dest='json', help='json output')
+    args = parser.parse_args()
+    assert args.zk, 'either set $OCHOPOD_ZK or use -z'
+
+    proxy = ZK.start(args.zk.split(','))
+    try:
+        js = _measure(proxy, max(args.calls, 1))
+        if args.json:
+            print(json.dumps(js))
+        else:
+            print('%d calls -> mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms' % (js['calls'], js['mean'], js['p50'], js['p99'], js['max']))
+
+    finally:
+        shutdown(proxy)
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Load test measuring the end-to-end latency and throughput of portal /shell requests (e.g what the CLI
+experiences). Each client thread re-uses its connection (keep-alive) and issues its share of the requests back to
+back. Run it against portals configured differently to compare them (for instance with $OCHOPOD_INPROCESS set to
+false or $OCHOPOD_SERVER set to werkzeug). The token (if any) is read from $OCHOPOD_TOKEN. For instance:
+
+ $ python benchmarks/shell.py -p 10.0.0.1:9000 -n 1000 -c 16 ls
+ 1000 x "ls" (16 clients) -> 812.4 req/s, mean 19.50 ms, p50 18.80 ms, p99 45.10 ms, max 61.30 ms (portal side p50 1.20 ms)
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import requests
+import time
+
+from argparse import ArgumentParser
+from threading import Thread
+
+
+def _measure(portal, line, n, clients):
+
+    headers = {'X-Shell': line}
+    token = os.environ.get('OCHOPOD_TOKEN', '')
+    if token:
+        headers['X-Signature'] = 'sha1=' + hmac.new(token, line, hashlib.sha1).hexdigest()
+
+    #
+    # - the first call absorbs whatever warm-up the portal needs
+    #
+    url = 'http://%s/shell' % portal
+    requests.post(url, headers=headers)
+    lapses = []
+    remote = []
+    failed = []
+
+    def _client(calls):
+        session = requests.Session()
+        for _ in range(calls):
+            ts = time.time()
+            try:
+                reply = session.post(url, headers=headers)
+                lapse = 1000 * (time.time() - ts)
+                js = json.loads(reply.text)
+                if not js['ok']:
+                    failed.append(js['out'])
+                    continue
+
+                lapses.append(lapse)
+                remote.append(js['ms'])
+
+            except Exception as failure:
+
+                failed.append(str(failure))
+
+    ts = time.time()
+    threads = [Thread(target=_client, args=(n / clients + (1 if i < n % clients else 0),)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - ts
+    assert lapses, '"%s" failed -> %s' % (line, failed[0] if failed else '?')
+    lapses.sort()
+    remote.sort()
+    ok = len(lapses)
+    return \
+        {
+            'line': line,
+            'calls': n,
+            'clients': clients,
+            'failed': len(failed),
+            'rps': ok / elapsed,
+            'mean': sum(lapses) / ok,
+            'p50': lapses[ok / 2],
+            'p99': lapses[min(ok - 1, int(ok * 0.99))],
+            'max': lapses[-1],
+            'portal p50': remote[ok / 2]
+        }
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='portal /shell load test')
+    parser.add_argument('line', type=str, nargs='*', default=['ls'], help='command line (ls by default)')
+    parser.add_argument('-c', action='store', dest='clients', type=int, default=1, help='number of concurrent clients')
+    parser.add_argument('-n', action='store', dest='calls', type=int, default=100, help='total number of requests')
+    parser.add_argument('-p', action='store', dest='portal', type=str, default='localhost:9000', help='portal ip:port')
+    parser.add_argument('-j', action='store_true', dest='json', help='json output')
+    args = parser.parse_args()
+
+    clients = max(args.clients, 1)
+    js = _measure(args.portal, ' '.join(args.line), max(args.calls, clients), clients)
+    if args.json:
+        print(json.dumps(js))
+    else:
+        print('%d x "%s" (%d clients) -> %.1f req/s, mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms (portal side p50 %.2f ms)%s' %
+              (js['calls'], js['line'], js['clients'], js['rps'], js['mean'], js['p50'], js['p99'], js['max'], js['portal p50'],
+               ', %d failed' % js['failed'] if js['failed'] else ''))
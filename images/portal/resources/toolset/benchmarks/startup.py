@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Startup benchmark for the toolset entry point (e.g what "toolset <command>" costs before doing anything useful). It
+reports:
+
+ - the cold & warm startup of each command, e.g the wall time of a "toolset <command> --help" sub-process (which
+   stops right after parsing the command line). Cold is the first run, warm the median of the next ones. For a truly
+   cold figure remove the .pyc files and drop the OS page cache beforehand.
+ - the import time of each module (self time, e.g excluding whatever it imports itself) for one given command.
+ - the Template.run() setup phases of that command (parsing, zookeeper actor start, connection, first query and
+   shutdown). This one requires a zookeeper ensemble (-z) and actually runs the command, so stick to read-only
+   commands (ls by default).
+
+The toolset must be importable (either installed or via $PYTHONPATH). Results can be saved as a json baseline (-o) and
+compared against a previous baseline (-b), in which case the script exits with 1 if anything regressed past the
+tolerance. For instance:
+
+ $ python benchmarks/startup.py -o baseline.json
+ $ python benchmarks/startup.py -b baseline.json -z 10.0.0.1:2181
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+
+#: Differences below that many milliseconds are considered noise when comparing against a baseline.
+FLOOR = 5.0
+
+
+def _child_imports(tokens):
+
+    #
+    # - hook __import__ and time each call, subtracting whatever nested imports took
+    # - then load the tool the same way dispatch() does
+    #
+    import __builtin__
+    original = __builtin__.__import__
+    stack = [0.0]
+    spent = {}
+
+    def _qualify(name, scope, fromlist):
+
+        #
+        # - resolve implicit & explicit relative imports (e.g 'url' from within urllib3.util)
+        #
+        package = (scope or {}).get('__package__') or (scope or {}).get('__name__', '')
+        if not name:
+            return '%s.%s' % (package, ','.join(fromlist or []))
+
+        local = '%s.%s' % (package, name)
+        return local if package and sys.modules.get(local) is not None else name
+
+    def _import(name, scope=None, names=None, fromlist=None, level=-1):
+        stack.append(0.0)
+        ts = time.time()
+        try:
+            return original(name, scope, names, fromlist, level)
+
+        finally:
+            lapse = time.time() - ts
+            nested = stack.pop()
+            stack[-1] += lapse
+            key = _qualify(name, scope, fromlist)
+            spent[key] = spent.get(key, 0.0) + lapse - nested
+
+    __builtin__.__import__ = _import
+    try:
+        from toolset.main import index, pick
+        scripts = index()
+        tag = ' '.join(tokens)
+        assert tag in scripts, 'unknown command "%s"' % tag
+        pick(tag)
+
+    finally:
+        __builtin__.__import__ = original
+
+    return {'total': 1000 * stack[0], 'modules': {name: 1000 * lapse for name, lapse in spent.items()}}
+
+
+def _child_phases(tokens):
+
+    #
+    # - turn tracing on (the tool will not restart it) and run the command
+    # - keep the setup spans
+    #
+    from toolset import trace
+    from toolset.main import dispatch
+    ts = time.time()
+    trace.start()
+    code = dispatch(tokens)
+    events = trace.stop(os.devnull)
+    phases = {'total': 1000 * (time.time() - ts), 'code': code}
+    for event in events:
+        if event['ph'] == 'X' and event['name'] in ['parse', 'start', 'connect', 'run', 'shutdown']:
+            name = 'first run' if event['name'] == 'run' else event['name']
+            phases.setdefault(name, event['dur'] / 1000.0)
+
+    return phases
+
+
+def _spawn(args, env=None):
+
+    ts = time.time()
+    with open(os.devnull, 'wb') as null:
+        code = subprocess.call(args, stdout=null, stderr=null, env=env)
+
+    return 1000 * (time.time() - ts), code
+
+
+def _startup(tokens, runs):
+
+    lapses = []
+    for _ in range(runs + 1):
+        lapse, code = _spawn([sys.executable, '-c', 'from toolset.main import go; go()'] + tokens + ['--help'])
+        assert code == 0, '"toolset %s --help" failed (exit code %d)' % (' '.join(tokens), code)
+        lapses.append(lapse)
+
+    warm = sorted(lapses[1:])
+    return {'cold': lapses[0], 'warm': warm[len(warm) / 2]}
+
+
+def _child(mode, tokens, env=None):
+
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode] + tokens, env=env)
+    return json.loads(out.splitlines()[-1])
+
+
+def _flatten(js, prefix=''):
+
+    flat = {}
+    for key, value in js.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, '%s%s.' % (prefix, key)))
+        elif isinstance(value, float):
+            flat['%s%s' % (prefix, key)] = value
+
+    return flat
+
+
+def _compare(baseline, js, tolerance):
+
+    #
+    # - compare every timing present in both (per-module import times are skipped, they are too noisy)
+    # - flag anything slower by more than the tolerance and the noise floor
+    #
+    before = _flatten(baseline)
+    after = _flatten(js)
+    regressions = 0
+    for key in sorted(set(before) & set(after)):
+        if key.startswith('imports.modules.'):
+            continue
+
+        old, new = before[key], after[key]
+        worse = new - old > FLOOR and new > old * (1.0 + tolerance)
+        regressions += worse
+        print('%-40s %9.2f ms -> %9.2f ms (%+6.1f%%)%s' %
+              (key, old, new, 100.0 * (new - old) / old if old else 0.0, '  <- regression' if worse else ''))
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        mode, tokens = sys.argv[2], sys.argv[3:]
+        print(json.dumps(_child_imports(tokens) if mode == 'imports' else _child_phases(tokens)))
+        sys.exit(0)
+
+    parser = ArgumentParser(description='toolset startup benchmark')
+    parser.add_argument('commands', type=str, nargs='*', help='commands to measure (all of them by default)')
+    parser.add_argument('-c', action='store', dest='profiled', type=str, default='ls', help='command to profile (ls by default)')
+    parser.add_argument('-n', action='store', dest='runs', type=int, default=5, help='number of warm runs per command')
+    parser.add_argument('-z', action='store', dest='zk', type=str, help='zookeeper ensemble (enables the phases)')
+    parser.add_argument('-o', action='store', dest='output', type=str, help='json file to write the results to')
+    parser.add_argument('-b', action='store', dest='baseline', type=str, help='json baseline to compare against')
+    parser.add_argument('--tolerance', action='store', type=float, default=0.25, help='regression tolerance (0.25 by default)')
+    parser.add_argument('--top', action='store', type=int, default=15, help='number of imports to display')
+    args = parser.parse_args()
+
+    from toolset.main import index
+    commands = args.commands or sorted(index().keys())
+    js = \
+        {
+            'python': platform.python_version(),
+            'host': platform.node(),
+            'when': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'startup': {},
+        }
+
+    for command in commands:
+        js['startup'][command] = _startup(command.split(' '), max(args.runs, 1))
+        print('%-10s cold %8.2f ms, warm %8.2f ms' % (command, js['startup'][command]['cold'], js['startup'][command]['warm']))
+
+    js['imports'] = _child('imports', args.profiled.split(' '))
+    print('\n%s imports -> %.2f ms' % (args.profiled, js['imports']['total']))
+    for name, lapse in sorted(js['imports']['modules'].items(), key=lambda pair: -pair[1])[:args.top]:
+        print(' %-40s %8.2f ms' % (name, lapse))
+
+    if args.zk:
+        env = dict(os.environ)
+        env['OCHOPOD_ZK'] = args.zk
+        js['phases'] = _child('phases', args.profiled.split(' '), env=env)
+        print('\n%s phases -> %s' % (args.profiled, ', '.join('%s %.2f ms' % (key, value) for key, value in sorted(js['phases'].items()) if key != 'code')))
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(json.dumps(js, indent=4, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.loads(f.read())
+
+        print('\ncompared to %s (%s) :' % (args.baseline, baseline.get('when', '?')))
+        sys.exit(1 if _compare(baseline, js, args.tolerance) else 0)
@@ -20,15 +20,36 @@ import ez_setup
 ez_setup.use_setuptools()
 
 from ochopod import __version__
+from os.path import join
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+from toolset import manifest
 
 if sys.version_info < (2, 7):
     raise NotImplementedError("python 2.7 or higher required")
 
+
+class _Build(build_py):
+    """
+    Regular build plus the command manifest (which lets the toolset import only the tool it runs).
+    """
+
+    def run(self):
+        build_py.run(self)
+
+        if not self.dry_run:
+            scripts = manifest.write(join(self.build_lib, 'toolset', 'commands'))
+            print('command manifest -> %s' % ', '.join(sorted(tag for js in scripts.values() for tag in js['tags'])))
+
+
 setup(
     name='toolset',
     version=__version__,
     packages=find_packages(),
+    cmdclass=
+    {
+        'build_py': _Build
+    },
     install_requires=
     [
         'kazoo>=2.0.0',
@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import logging
+import shlex
+import time
+
+from Queue import Empty, Queue
+from threading import Thread
+from toolset.io import session
+from toolset.main import capture, dispatch, isolated
+from toolset.tool import Isolated, Template
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+
+def go():
+
+    class _Tool(Template):
+
+        help = \
+            '''
+                Runs a sequence of commands in one go, sharing the same zookeeper session. The command lines are
+                either read from a script (one per line, # for comments) or passed via -e. Each command is run in turn
+                and its exit code reported. Use --stop to give up upon the first failure. Any file the commands need
+                (e.g YAML container definitions) can be listed after the script.
+
+                The -p switch runs up to that many commands concurrently. Commands are then assumed to be independent
+                unless separated by a "wait" line (everything before it must complete first). Outputs are displayed
+                in order once the commands are done.
+
+                This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
+            '''
+
+        tag = 'batch'
+
+        def customize(self, parser):
+
+            parser.add_argument('script', type=str, nargs='?', help='script (one command line per line)')
+            parser.add_argument('files', type=str, nargs='*', help='files the commands use (e.g to get them uploaded by the cli)')
+            parser.add_argument('-e', action='append', dest='lines', default=[], help='command line (can be repeated)')
+            parser.add_argument('-j', action='store_true', dest='json', help='json output')
+            parser.add_argument('-p', action='store', dest='parallel', type=int, default=1, help='max # of concurrent commands')
+            parser.add_argument('--stop', action='store_true', help='stop upon the first failure')
+
+        def body(self, args, _, proxy):
+
+            lines = []
+            if args.script:
+                with open(args.script, 'r') as f:
+                    lines += [line.strip() for line in f.readlines()]
+
+            lines += args.lines
+            lines = [line for line in lines if line and not line.startswith('#')]
+            assert lines, 'no command to run (user error ?)'
+
+            #
+            # - split the lines into groups separated by 'wait'
+            # - we'll run each group in turn
+            #
+            groups = [[]]
+            for line in lines:
+                if line == 'wait':
+                    groups.append([])
+                else:
+                    tokens = shlex.split(line)
+                    assert tokens[0] != self.tag, 'batch cannot be nested'
+                    groups[-1].append((line, tokens))
+
+            #
+            # - we may be sharing our process with other commands (e.g within the portal)
+            # - in that case find out upfront whether some line needs its own process (-d or --trace) and let our
+            #   caller run us again in a sub-process before anything is run
+            #
+            if session() is not None and any(isolated(tokens) for group in groups for _, tokens in group):
+                raise Isolated('some lines need their own process (-d or --trace)')
+
+            outcome = []
+            failed = 0
+            total = sum(len(group) for group in groups)
+            for group in [group for group in groups if group]:
+
+                def _run(tokens, out):
+
+                    #
+                    # - run the command on our proxy and time it
+                    # - its output is captured unless we are running sequentially in text mode
+                    #
+                    ts = time.time()
+                    if out is None:
+                        code = dispatch(tokens, proxy=proxy)
+                    else:
+                        with capture(out):
+                            code = dispatch(tokens, proxy=proxy)
+
+                    return code, int(1000 * (time.time() - ts))
+
+                if args.parallel > 1 or args.json:
+
+                    #
+                    # - run the group on a few threads pulling from a fifo
+                    # - keep the results in order (commands skipped because of --stop have none)
+                    #
+                    fifo = Queue()
+                    results = [None] * len(group)
+                    for n, (line, tokens) in enumerate(group):
+                        fifo.put((n, tokens))
+
+                    def _work():
+                        while 1:
+                            try:
+                                n, tokens = fifo.get_nowait()
+
+                            except Empty:
+                                return
+
+                            if args.stop and any(result and result[0] for result in results):
+                                return
+
+                            out = []
+                            code, ms = _run(tokens, out)
+                            results[n] = (code, ms, out)
+
+                    threads = [Thread(target=_work) for _ in range(min(max(args.parallel, 1), len(group)))]
+                    for thread in threads:
+                        thread.start()
+
+                    for thread in threads:
+                        thread.join()
+
+                    for (line, _), result in zip(group, results):
+                        if result is None:
+                            continue
+
+                        code, ms, out = result
+                        outcome.append({'line': line, 'code': code, 'ms': ms, 'out': out})
+                        if not args.json:
+                            logger.info('[%d/%d] %s ->' % (len(outcome), total, line))
+                            for text in out:
+                                logger.info(text)
+                            logger.info('<- exit code %d (%d ms)\n' % (code, ms))
+
+                else:
+
+                    #
+                    # - run the group one command at a time, their output goes straight to ours
+                    #
+                    for line, tokens in group:
+                        logger.info('[%d/%d] %s ->' % (len(outcome) + 1, total, line))
+                        code, ms = _run(tokens, None)
+                        outcome.append({'line': line, 'code': code, 'ms': ms})
+                        logger.info('<- exit code %d (%d ms)\n' % (code, ms))
+                        if code and args.stop:
+                            break
+
+                failed = sum(1 for js in outcome if js['code'])
+                if failed and args.stop:
+                    break
+
+            if args.json:
+                logger.info(json.dumps(outcome))
+            else:
+                logger.info('%d/%d commands succeeded' % (len(outcome) - failed, total))
+
+            return 0 if not failed and len(outcome) == total else 1
+
+    return _Tool()
@@ -21,10 +21,11 @@ import os
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import merge, retry, shell
 from random import choice
-from requests import get, put, post
 from threading import Thread
-from toolset.io import fire, run
+from toolset.io import Locks
+from toolset.marathon import get, put, post
 from toolset.tool import Template
+from toolset.trace import traced
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
@@ -32,16 +33,16 @@ logger = logging.getLogger('ochopod')
 
 class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, strict, timeout, version):
+    def __init__(self, context, cluster, strict, timeout, version):
         super(_Automation, self).__init__()
 
         self.cluster = cluster
+        self.context = context
         self.out = \
             {
                 'ok': False,
                 'up': []
             }
-        self.proxy = proxy
         self.strict = strict
         self.timeout = timeout
         self.version = version
@@ -67,11 +68,7 @@ class _Automation(Thread):
             # - they should all map to one single marathon application (abort if not)
             # - we'll use the application identifier to retrieve the configuration json later on
             #
-            def _query(zk):
-                replies = fire(zk, self.cluster, 'info')
-                return [hints['application'] for (_, hints, _) in replies.values()]
-
-            js = run(self.proxy, _query)
+            js = [hints['application'] for (_, hints, _) in self.context.info(self.cluster).values()]
             assert len(set(js)) == 1, '%s is mapping to 2+ marathon applications' % self.cluster
             app = js[0]
 
@@ -106,23 +103,7 @@ class _Automation(Thread):
             # - kill all the pods using a POST /control/kill
             # - wait for them to be dead
             #
-            @retry(timeout=self.timeout, pause=0)
-            def _spin():
-                def _query(zk):
-                    replies = fire(zk, self.cluster, 'control/kill', timeout=self.timeout)
-                    return [(code, seq) for seq, _, code in replies.values()]
-
-                #
-                # - fire the request one or more pods
-                # - wait for every pod to report back a HTTP 410 (GONE)
-                # - this means the ochopod state-machine is now idling (e.g dead)
-                #
-                js = run(self.proxy, _query)
-                gone = sum(1 for code, _ in js if code == 410)
-                assert gone == len(js), 'at least one pod is still running'
-                return
-
-            _spin()
+            self.context.kill(self.cluster, timeout=self.timeout)
 
             #
             # - grab the docker image
@@ -149,15 +130,24 @@ class _Automation(Thread):
             # - the pods should now be starting
             # - wait for all the pods to be in the 'running' mode (they are 'dead' right now)
             # - the sequence counters allocated to our new pods are returned as well
+            # - stream the replies in and stop as soon as we have enough pods
             #
             target = ['running'] if self.strict else ['stopped', 'running']
             @retry(timeout=self.timeout, pause=3, default={})
+            @traced('spin')
             def _spin():
-                def _query(zk):
-                    replies = fire(zk, self.cluster, 'info')
-                    return [(hints['process'], seq) for seq, hints, _ in replies.values() if hints['process'] in target]
 
-                js = run(self.proxy, _query)
+                #
+                # - the pods are being re-created, drop whatever we know about the cluster
+                #
+                js = []
+                self.context.invalidate(self.cluster)
+                for _, seq, hints, _ in self.context.stream(self.cluster, 'info'):
+                    if hints['process'] in target:
+                        js.append((hints['process'], seq))
+                        if len(js) == capacity:
+                            break
+
                 assert len(js) == capacity, 'not all pods running yet'
                 return js
 
@@ -206,20 +196,25 @@ def go():
             assert len(args.clusters), 'at least one cluster is required'
 
             #
-            # - run the workflow proper (one thread per container definition)
+            # - lock the clusters first (other portals may be operating on them as well)
             #
-            threads = {cluster: _Automation(
-                proxy,
-                cluster,
-                args.strict,
-                args.timeout,
-                args.version) for cluster in args.clusters}
+            with Locks(proxy, args.clusters, timeout=args.timeout):
 
-            #
-            # - wait for all our threads to join
-            #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+                #
+                # - run the workflow proper (one thread per container definition)
+                #
+                threads = {cluster: _Automation(
+                    args.context,
+                    cluster,
+                    args.strict,
+                    args.timeout,
+                    args.version) for cluster in args.clusters}
+
+                #
+                # - wait for all our threads to join
+                #
+                n = len(threads)
+                outcome = {key: thread.join() for key, thread in threads.items()}
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
             up = sum(len(js['up']) for _, js in outcome.items())
             logger.info(json.dumps(outcome) if args.json else '%d%% success (%d pods)' % (pct, up))
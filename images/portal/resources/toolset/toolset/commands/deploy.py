@@ -22,17 +22,21 @@ import time
 import yaml
 
 from ochopod.core.fsm import diagnostic
-from ochopod.core.utils import merge, retry, shell
+from ochopod.core.utils import merge, shell
 from random import choice
-from requests import delete, post
 from threading import Thread
-from toolset.io import fire, run
+from toolset.io import scatter, Arrivals, Locks
+from toolset.marathon import delete, post
 from toolset.tool import Template
+from toolset.trace import traced
 from yaml import YAMLError
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Maximum pause in seconds between two /info rounds while waiting for the new pods to be ready.
+POLL = 1.0
+
 
 class _Automation(Thread):
 
@@ -57,6 +61,8 @@ class _Automation(Thread):
         self.start()
 
     def run(self):
+        arrivals = None
+        locks = None
         try:
 
             #
@@ -110,6 +116,11 @@ class _Automation(Thread):
                 stamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d-%H-%M-%S')
                 qualified = '%s.%s' % (self.namespace, cfg['cluster'])
                 application = 'ochopod.%s-%s' % (qualified, stamp)
+
+                #
+                # - lock the cluster (other portals may be deploying, scaling or killing it as well)
+                #
+                locks = Locks(self.proxy, [qualified], timeout=self.timeout)
                 if qualified in self.overrides:
 
                     blk = self.overrides[qualified]
@@ -245,6 +256,12 @@ class _Automation(Thread):
                 if 'verbatim' in cfg:
                     spec = merge(cfg['verbatim'], spec)
 
+                #
+                # - watch the cluster for the pods of our new application before submitting it
+                # - pods not reporting the application hint in zookeeper are kept (their /info will tell)
+                #
+                arrivals = Arrivals(self.proxy, qualified, match=lambda hints: hints.get('application', application) == application)
+
                 #
                 # - pick a marathon master at random
                 # - fire the POST /v2/apps to create our application
@@ -260,20 +277,33 @@ class _Automation(Thread):
                 # - wait for all the pods to be in the 'running' mode
                 # - the 'application' hint is set by design to the marathon application identifier
                 # - the sequence counters allocated to our new pods are returned as well
+                # - only query the new pods that are not ready yet, as soon as they register in zookeeper
+                # - the pod state does not show in zookeeper : re-query the pending pods every POLL seconds
+                # - stop as soon as we have enough pods (or report nothing upon timeout)
                 #
                 target = ['dead', 'running'] if self.strict else ['dead', 'stopped', 'running']
-                @retry(timeout=self.timeout, pause=3, default={})
+                ready = {}
+
+                @traced('spin')
                 def _spin():
-                    def _query(zk):
-                        replies = fire(zk, qualified, 'info')
-                        return [(hints['process'], seq) for seq, hints, _ in replies.values()
-                                if hints['application'] == application and hints['process'] in target]
+                    pending = {key: hints for key, hints in arrivals.snapshot().items() if key not in ready}
+                    if not pending:
+                        return
+
+                    for key, seq, hints, code, _ in scatter(pending, 'info'):
+                        if code and hints['application'] == application and hints['process'] in target:
+                            ready[key] = (hints['process'], seq)
+
+                deadline = time.time() + self.timeout
+                while 1:
+                    _spin()
+                    left = deadline - time.time()
+                    if len(ready) >= self.pods or left <= 0:
+                        break
 
-                    js = run(self.proxy, _query)
-                    assert len(js) == self.pods, 'not all pods running yet'
-                    return js
+                    arrivals.wait(min(POLL, left))
 
-                js = _spin()
+                js = ready.values() if len(ready) >= self.pods else []
                 running = sum(1 for state, _ in js if state is not 'dead')
                 up = [seq for _, seq in js]
                 self.out['up'] = up
@@ -307,6 +337,14 @@ class _Automation(Thread):
 
             logger.debug('%s : failed to deploy -> %s' % (self.template, diagnostic(failure)))
 
+        finally:
+
+            if arrivals is not None:
+                arrivals.stop()
+
+            if locks is not None:
+                locks.release()
+
     def join(self, timeout=None):
 
         Thread.join(self)
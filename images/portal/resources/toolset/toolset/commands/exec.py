@@ -18,7 +18,6 @@ import json
 import logging
 
 from os import path
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -75,11 +74,9 @@ def go():
                     with open(token, 'rb') as f:
                         files[token] = f.read()
 
-            def _query(zk):
-                replies = fire(zk, args.clusters[0], 'exec', subset=args.indices, headers=headers, files=files, timeout=args.timeout)
-                return len(replies), {key: js for key, (_, js, code) in replies.items() if code == 200}
-
-            total, js = run(proxy, _query)
+            replies = args.context.fire(args.clusters[0], 'exec', subset=args.indices, headers=headers, files=files, timeout=args.timeout)
+            total = len(replies)
+            js = {key: js for key, (_, js, code) in replies.items() if code == 200}
             pct = ((len(js) * 100) / total) if total else 0
             if args.json:
                 logger.info(json.dumps(js))
@@ -16,7 +16,6 @@
 #
 import logging
 import json
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -31,6 +30,9 @@ def go():
             '''
                 Displays high-level information for the specified cluster(s).
 
+                The --deadline switch bounds how long the pods are queried for (the ones that did not reply by then
+                are left out). The --hedge switch re-queries the slowest pods once the specified fraction replied.
+
                 This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
             '''
 
@@ -40,15 +42,19 @@ def go():
 
             parser.add_argument('clusters', type=str, nargs='?', default='*', help='cluster(s) (can be a glob pattern, e.g foo*)')
             parser.add_argument('-j', '--json', action='store_true', help='switch for json output')
+            parser.add_argument('--deadline', action='store', type=float, help='give up on the pods not replying within that many seconds')
+            parser.add_argument('--hedge', action='store', type=float, help='re-query the stragglers once that fraction of the pods replied, e.g 0.9')
 
         def body(self, args, _, proxy):
 
-            def _query(zk):
-                replies = fire(zk, args.clusters, 'info')
-                return len(replies), [[key, '|', hints['ip'], '|', hints['node'], '|', hints['process'], '|', hints['state']]
-                                      for key, (_, hints, code) in sorted(replies.items()) if code == 200]
-
-            total, js = run(proxy, _query)
+            #
+            # - survey all the pods (the ones that did not reply count against the reply ratio)
+            # - --deadline bounds the whole fan-out and --hedge re-sends /info to the slowest pods
+            #
+            replies = args.context.survey(args.clusters, 'info', deadline=args.deadline, hedge=args.hedge)
+            total = len(replies)
+            js = [[key, '|', hints['ip'], '|', hints['node'], '|', hints['process'], '|', hints['state']]
+                  for key, (_, hints, code, _) in sorted(replies.items()) if code == 200]
             pct = ((len(js) * 100) / total) if total else 0
             if args.json:
                 out = {item[0]: {'ip': item[2], 'node': item[4], 'process': item[6], 'state': item[8]} for item in js}
@@ -19,11 +19,10 @@ import logging
 import os
 
 from ochopod.core.fsm import diagnostic
-from ochopod.core.utils import retry
 from random import choice
-from requests import get, delete, post
 from threading import Thread
-from toolset.io import fire, run
+from toolset.io import Locks
+from toolset.marathon import get, delete, post
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -32,16 +31,16 @@ logger = logging.getLogger('ochopod')
 
 class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, indices, timeout):
+    def __init__(self, context, cluster, indices, timeout):
         super(_Automation, self).__init__()
 
         self.cluster = cluster
+        self.context = context
         self.out = \
             {
                 'ok': False,
                 'down': []
             }
-        self.proxy = proxy
         self.indices = indices
         self.timeout = max(timeout, 5)
 
@@ -65,24 +64,9 @@ class _Automation(Thread):
             # - kill all (or part of) the pods using a POST /control/kill
             # - wait for them to be dead
             # - warning, /control/kill will block (hence the 5 seconds timeout)
+            # - the pods are looked up once (the context memoizes them)
             #
-            @retry(timeout=self.timeout, pause=0)
-            def _spin():
-                def _query(zk):
-                    replies = fire(zk, self.cluster, 'control/kill', subset=self.indices, timeout=self.timeout)
-                    return [(code, seq) for seq, _, code in replies.values()]
-
-                #
-                # - fire the request one or more pods
-                # - wait for every pod to report back a HTTP 410 (GONE)
-                # - this means the ochopod state-machine is now idling (e.g dead)
-                #
-                js = run(self.proxy, _query)
-                gone = sum(1 for code, _ in js if code == 410)
-                assert gone == len(js), 'at least one pod is still running'
-                return [seq for _, seq in js]
-
-            down = _spin()
+            down = self.context.kill(self.cluster, subset=self.indices, timeout=self.timeout)
             self.out['down'] = down
             assert down, 'the cluster is either invalid or empty'
             logger.debug('%s : %d dead pods -> %s' % (self.cluster, len(down), ', '.join(['#%d' % seq for seq in down])))
@@ -91,11 +75,8 @@ class _Automation(Thread):
             # - now peek and see what pods we have
             # - we want to know what the underlying marathon application & task are
             #
-            def _query(zk):
-                replies = fire(zk, self.cluster, 'info', subset=self.indices)
-                return [(hints['application'], hints['task']) for _, hints, _ in replies.values()]
-
-            js = run(self.proxy, _query)
+            replies = self.context.info(self.cluster, subset=self.indices)
+            js = [(hints['application'], hints['task']) for _, hints, _ in replies.values()]
             rollup = {key: [] for key in set([key for key, _ in js])}
             for app, task in js:
                 rollup[app] += [task]
@@ -189,19 +170,24 @@ def go():
             assert args.force or args.indices, 'you must specify --force if -i is not set'
 
             #
-            # - run the workflow proper (one thread per cluster identifier)
+            # - lock the clusters first (other portals may be operating on them as well)
             #
-            threads = {cluster: _Automation(
-                proxy,
-                cluster,
-                args.indices,
-                args.timeout) for cluster in args.clusters}
+            with Locks(proxy, args.clusters, timeout=args.timeout):
 
-            #
-            # - wait for all our threads to join
-            #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+                #
+                # - run the workflow proper (one thread per cluster identifier)
+                #
+                threads = {cluster: _Automation(
+                    args.context,
+                    cluster,
+                    args.indices,
+                    args.timeout) for cluster in args.clusters}
+
+                #
+                # - wait for all our threads to join
+                #
+                n = len(threads)
+                outcome = {key: thread.join() for key, thread in threads.items()}
             dead = sum(len(js['down']) for _, js in outcome.items())
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
             logger.info(json.dumps(outcome) if args.json else '%d%% success (-%d pods)' % (pct, dead))
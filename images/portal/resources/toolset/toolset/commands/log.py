@@ -16,7 +16,6 @@
 #
 import logging
 
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -43,11 +42,9 @@ def go():
 
         def body(self, args, _, proxy):
 
-            def _query(zk):
-                replies = fire(zk, args.clusters, 'log', subset=args.indices)
-                return len(replies), {key: log for key, (_, log, code) in replies.items() if code == 200}
-
-            total, js = run(proxy, _query)
+            replies = args.context.fire(args.clusters, 'log', subset=args.indices)
+            total = len(replies)
+            js = {key: log for key, (_, log, code) in replies.items() if code == 200}
             pct = ((len(js) * 100) / total) if total else 0
             if js:
 
@@ -17,7 +17,6 @@
 import json
 import logging
 
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -33,6 +32,9 @@ def go():
                 Lists all the ochopod cluster(s) currently active. The number of containers that are tagged as running
                 is indicated as well as the optional status status line.
 
+                The --deadline switch bounds how long the pods are queried for (the ones that did not reply by then
+                are left out). The --hedge switch re-queries the slowest pods once the specified fraction replied.
+
                 This tool supports optional output in JSON format for 3rd-party integration via the -j switch.
             '''
 
@@ -41,15 +43,20 @@ def go():
         def customize(self, parser):
 
             parser.add_argument('-j', action='store_true', dest='json', help='json output')
+            parser.add_argument('--deadline', action='store', type=float, help='give up on the pods not replying within that many seconds')
+            parser.add_argument('--hedge', action='store', type=float, help='re-query the stragglers once that fraction of the pods replied, e.g 0.9')
 
         def body(self, args, _, proxy):
 
-            def _query(zk):
-                replies = fire(zk, '*', 'info')
-                return len(replies), {key: hints for key, (_, hints, code) in replies.items() if code == 200}
+            #
+            # - survey all the pods (the ones that did not reply count against the reply ratio)
+            # - --deadline bounds the whole fan-out and --hedge re-sends /info to the slowest pods
+            #
+            replies = args.context.survey('*', 'info', deadline=args.deadline, hedge=args.hedge)
+            total = len(replies)
+            js = {key: hints for key, (_, hints, code, _) in replies.items() if code == 200}
 
             out = {}
-            total, js = run(proxy, _query)
             pct = ((len(js) * 100) / total) if total else 0
             for key, hints in js.items():
                 qualified = key.split(' ')[0]
@@ -21,7 +21,6 @@ import os
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import retry
 from threading import Thread
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -30,16 +29,16 @@ logger = logging.getLogger('ochopod')
 
 class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, indices, timeout):
+    def __init__(self, context, cluster, indices, timeout):
         super(_Automation, self).__init__()
 
         self.cluster = cluster
+        self.context = context
         self.out = \
             {
                 'ok': False,
                 'on': []
             }
-        self.proxy = proxy
         self.indices = indices
         self.timeout = max(timeout, 5)
 
@@ -48,11 +47,9 @@ class _Automation(Thread):
     def run(self):
         try:
 
-            def _query(zk):
-                replies = fire(zk, self.cluster, 'control/on', subset=self.indices, timeout=self.timeout)
-                return len(replies), [seq for seq, (_, _, code) in replies.items() if code == 200]
-
-            total, js = run(self.proxy, _query)
+            replies = self.context.fire(self.cluster, 'control/on', subset=self.indices, timeout=self.timeout)
+            total = len(replies)
+            js = [seq for seq, (_, _, code) in replies.items() if code == 200]
             assert len(js) == total, '1 or more pod failed to stop'
 
             self.out['on'] = js
@@ -102,7 +99,7 @@ def go():
             # - run the workflow proper (one thread per cluster identifier)
             #
             threads = {cluster: _Automation(
-                proxy,
+                args.context,
                 cluster,
                 args.indices,
                 args.timeout) for cluster in args.clusters}
@@ -16,7 +16,6 @@
 #
 import logging
 import json
-from toolset.io import fire, run, ZK
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -42,11 +41,9 @@ def go():
 
         def body(self, args, _, proxy):
 
-            def _query(zk):
-                replies = fire(zk, args.clusters, 'info')
-                return len(replies), {key: hints['metrics'] for key, (index, hints, code) in replies.items() if code == 200 and 'metrics' in hints}
-
-            total, js = run(proxy, _query)
+            replies = args.context.fire(args.clusters, 'info')
+            total = len(replies)
+            js = {key: hints['metrics'] for key, (index, hints, code) in replies.items() if code == 200 and 'metrics' in hints}
             pct = ((len(js) * 100) / total) if total else 0
             if args.json:
                 logger.info(json.dumps(js))
@@ -16,7 +16,6 @@
 #
 import logging
 import json
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -47,11 +46,9 @@ def go():
 
             port = str(args.port[0])
 
-            def _query(zk):
-                replies = fire(zk, args.clusters, 'info')
-                return len(replies), [[key, '|', hints['ip'], '|', hints['public'], '|', str(hints['ports'][port])] for key, (_, hints, code) in sorted(replies.items()) if code == 200 and port in hints['ports']]
-
-            total, js = run(proxy, _query)
+            replies = args.context.fire(args.clusters, 'info')
+            total = len(replies)
+            js = [[key, '|', hints['ip'], '|', hints['public'], '|', str(hints['ports'][port])] for key, (_, hints, code) in sorted(replies.items()) if code == 200 and port in hints['ports']]
             pct = (len(js) * 100) / total if total else 0
             if args.json:
                 out = {item[0]: {'ip': item[2], 'public': item[4], 'ports': item[6]} for item in js}
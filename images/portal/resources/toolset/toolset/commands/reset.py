@@ -19,7 +19,6 @@ import logging
 
 from ochopod.core.fsm import diagnostic
 from threading import Thread
-from toolset.io import fire, run
 from toolset.tool import Template
 
 #: Our ochopod logger.
@@ -28,17 +27,17 @@ logger = logging.getLogger('ochopod')
 
 class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, indices, timeout):
+    def __init__(self, context, cluster, indices, timeout):
         super(_Automation, self).__init__()
 
         self.cluster = cluster
+        self.context = context
         self.indices = indices
         self.out = \
             {
                 'ok': False,
                 'reset': []
             }
-        self.proxy = proxy
         self.timeout = timeout
 
         self.start()
@@ -49,21 +48,16 @@ class _Automation(Thread):
             #
             # - first turn off the pods
             # - keep track of the indices
+            # - the pods are looked up once (the context memoizes them)
             #
-            def _query(zk):
-                replies = fire(zk, self.cluster, 'control/off', subset=self.indices, timeout=self.timeout)
-                return [seq for _, (seq, _, code) in replies.items() if code == 200]
-
-            pods = run(self.proxy, _query)
+            replies = self.context.fire(self.cluster, 'control/off', subset=self.indices, timeout=self.timeout)
+            pods = [seq for _, (seq, _, code) in replies.items() if code == 200]
 
             #
             # - then turn those pod back on
             #
-            def _query(zk):
-                replies = fire(zk, self.cluster, 'control/on', subset=pods, timeout=self.timeout)
-                return [seq for _, (seq, _, code) in replies.items() if code == 200]
-
-            assert pods == run(self.proxy, _query), 'one or more pods failed to switch back on'
+            replies = self.context.fire(self.cluster, 'control/on', subset=pods, timeout=self.timeout)
+            assert pods == [seq for _, (seq, _, code) in replies.items() if code == 200], 'one or more pods failed to switch back on'
 
             self.out['reset'] = pods
             self.out['ok'] = True
@@ -113,7 +107,7 @@ def go():
             #
             # - run the workflow proper (one thread per container definition)
             #
-            threads = {cluster: _Automation(proxy, cluster, args.indices, args.timeout) for cluster in args.clusters}
+            threads = {cluster: _Automation(args.context, cluster, args.indices, args.timeout) for cluster in args.clusters}
 
             #
             # - wait for all our threads to join
@@ -21,10 +21,11 @@ import os
 from ochopod.core.fsm import diagnostic
 from ochopod.core.utils import retry
 from random import choice
-from requests import post, put
 from threading import Thread
-from toolset.io import fire, run
+from toolset.io import Locks
+from toolset.marathon import post, put
 from toolset.tool import Template
+from toolset.trace import traced
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
@@ -32,10 +33,11 @@ logger = logging.getLogger('ochopod')
 
 class _Automation(Thread):
 
-    def __init__(self, proxy, cluster, factor, fifo, group, timeout):
+    def __init__(self, context, cluster, factor, fifo, group, timeout):
         super(_Automation, self).__init__()
 
         self.cluster = cluster
+        self.context = context
         self.factor = factor
         self.fifo = fifo
         self.group = group
@@ -43,7 +45,6 @@ class _Automation(Thread):
             {
                 'ok': False
             }
-        self.proxy = proxy
         self.timeout = max(timeout, 5)
 
         self.start()
@@ -64,16 +65,10 @@ class _Automation(Thread):
 
             #
             # - first peek and see what pods we have
-            #
-            def _query(zk):
-                replies = fire(zk, self.cluster, 'info')
-                return [(seq, hints['application'], hints['task']) for (seq, hints, _) in replies.values()]
-
-            #
             # - remap a bit differently and get an ordered list of task identifiers
             # - we'll use that to kill the newest pods
             #
-            js = run(self.proxy, _query)
+            js = [(seq, hints['application'], hints['task']) for (seq, hints, _) in self.context.info(self.cluster).values()]
             total = len(js)
             if self.group is not None:
 
@@ -130,12 +125,14 @@ class _Automation(Thread):
                 # - wait for all our new pods to be there
                 #
                 @retry(timeout=self.timeout, pause=3, default={})
+                @traced('spin')
                 def _spin():
-                    def _query(zk):
-                        replies = fire(zk, self.cluster, 'info')
-                        return [seq for seq, _, _ in replies.values()]
 
-                    js = run(self.proxy, _query)
+                    #
+                    # - new pods are coming up, drop whatever we know about the cluster
+                    #
+                    self.context.invalidate(self.cluster)
+                    js = [seq for seq, _, _ in self.context.info(self.cluster).values()]
                     assert len(js) == target, 'not all pods running yet'
                     return js
 
@@ -149,27 +146,10 @@ class _Automation(Thread):
                 tasks = tasks[:total - target] if self.fifo else tasks[target:]
 
                 #
-                # - kill all (or part of) the pods using a POST /control/kill
+                # - kill all (or part of) the pods using a POST /control/kill (re-using the pods we looked up initially)
                 # - wait for them to be dead
                 #
-                @retry(timeout=self.timeout, pause=0)
-                def _spin():
-                    def _query(zk):
-                        indices = [seq for (seq, _) in tasks]
-                        replies = fire(zk, self.cluster, 'control/kill', subset=indices, timeout=self.timeout)
-                        return [(code, seq) for seq, _, code in replies.values()]
-
-                    #
-                    # - fire the request one or more pods
-                    # - wait for every pod to report back a HTTP 410 (GONE)
-                    # - this means the ochopod state-machine is now idling (e.g dead)
-                    #
-                    js = run(self.proxy, _query)
-                    gone = sum(1 for code, _ in js if code == 410)
-                    assert gone == len(js), 'at least one pod is still running'
-                    return
-
-                _spin()
+                self.context.kill(self.cluster, subset=[seq for (seq, _) in tasks], timeout=self.timeout)
 
                 #
                 # - delete all the underlying tasks at once using POST v2/tasks/delete
@@ -232,21 +212,26 @@ def go():
         def body(self, args, unknown, proxy):
 
             #
-            # - run the workflow proper (one thread per cluster)
+            # - lock the clusters first (other portals may be operating on them as well)
             #
-            threads = {cluster: _Automation(
-                proxy,
-                cluster,
-                args.factor,
-                args.fifo,
-                args.group,
-                args.timeout) for cluster in args.clusters}
+            with Locks(proxy, args.clusters, timeout=args.timeout):
 
-            #
-            # - wait for all our threads to join
-            #
-            n = len(threads)
-            outcome = {key: thread.join() for key, thread in threads.items()}
+                #
+                # - run the workflow proper (one thread per cluster)
+                #
+                threads = {cluster: _Automation(
+                    args.context,
+                    cluster,
+                    args.factor,
+                    args.fifo,
+                    args.group,
+                    args.timeout) for cluster in args.clusters}
+
+                #
+                # - wait for all our threads to join
+                #
+                n = len(threads)
+                outcome = {key: thread.join() for key, thread in threads.items()}
             delta = sum(js['delta'] for _, js in outcome.items())
             pct = (100 * sum(1 for _, js in outcome.items() if js['ok'])) / n if n else 0
             logger.info(json.dumps(outcome) if args.json else '%d%% success (%+d pods)' % (pct, delta))
@@ -17,130 +17,896 @@
 import fnmatch
 import json
 import logging
+import os
 import pykka
 import requests
+import socket
+import sys
 import time
 
 from collections import deque
 from kazoo.client import KazooClient, KazooState
-from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import LockTimeout, NoNodeError
+from kazoo.recipe.watchers import ChildrenWatch, DataWatch
 from ochopod.core.core import ROOT
 from ochopod.core.fsm import diagnostic, shutdown, spin_lock, Aborted, FSM
 from pykka import Timeout
+from Queue import Empty, Queue
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout as HTTPTimeout
-from threading import Event, Thread
+from threading import Event, Lock, RLock, Thread
+from toolset import loop, metrics, trace
 
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: If true lookup() issues its znode reads using the kazoo async API (set $OCHOPOD_PIPELINED to false to disable).
+PIPELINED = os.environ.get('OCHOPOD_PIPELINED', 'true').lower() == 'true'
 
-def lookup(zk, regex, subset=None):
+#: Maximum number of threads used to fan HTTP queries out to the pods, shared by all the commands running within the
+#: process ($OCHOPOD_FANOUT, 256 by default).
+FANOUT = int(os.environ.get('OCHOPOD_FANOUT', '256'))
+
+#: Maximum number of HTTP queries one single fan-out has in flight at any time when using the thread pool
+#: ($OCHOPOD_FANOUT_CALL, 64 by default).
+FANOUT_CALL = int(os.environ.get('OCHOPOD_FANOUT_CALL', '64'))
+
+#: Maximum number of closures the zookeeper proxy actor runs concurrently ($OCHOPOD_CLOSURES, 16 by default).
+CLOSURES = int(os.environ.get('OCHOPOD_CLOSURES', '16'))
+
+#: Number of per-pod connection pools cached by our HTTP session ($OCHOPOD_HTTP_POOLS, 256 by default).
+HTTP_POOLS = int(os.environ.get('OCHOPOD_HTTP_POOLS', '256'))
+
+#: Number of keep-alive connections retained per pod ($OCHOPOD_HTTP_POOL_SIZE, 4 by default).
+HTTP_POOL_SIZE = int(os.environ.get('OCHOPOD_HTTP_POOL_SIZE', '4'))
+
+#: Fan-out engine used by fire(), either 'threads' (queries run on a bounded thread pool) or 'events' (queries
+#: multiplexed on one single event loop thread). This can be set via $OCHOPOD_ENGINE.
+ENGINE = os.environ.get('OCHOPOD_ENGINE', 'threads').lower()
+
+#: Zookeeper path under which the cluster locks are held (see Locks).
+LOCKS = '/ochothon/locks'
+
+#: Watch-backed registries, keyed by the zookeeper client they are attached to.
+registries = {}
+
+#: Bumped whenever a registry sees a change (see generation()).
+_generation = 0
+
+
+class Pool(object):
+    """
+    Bounded set of daemon threads running closures off a FIFO. Threads are spawned on demand (up to the size
+    limit) and then re-used for the lifetime of the process. Each submission returns a pykka future which is set
+    to whatever the closure returns (or raises).
+    """
+
+    def __init__(self, size):
+
+        self.fifo = Queue()
+        self.lock = Lock()
+        self.size = max(size, 1)
+        self.threads = []
+
+    def submit(self, func, *args):
+
+        latch = pykka.ThreadingFuture()
+        with self.lock:
+            if len(self.threads) < self.size:
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        self.fifo.put((func, args, latch))
+        return latch
+
+    def _work(self):
+
+        while 1:
+            func, args, latch = self.fifo.get()
+            try:
+                latch.set(func(*args))
+
+            except Exception:
+                latch.set_exception(sys.exc_info())
+
+
+#: Process-wide pool used by fire() to run the HTTP queries.
+fanout = Pool(FANOUT)
+
+#: Process-wide pool used by the zookeeper proxy actor to run the closures it receives.
+executor = Pool(CLOSURES)
+
+
+def _http():
+
+    #
+    # - the adapter maintains one urllib3 pool per host:port (e.g per pod endpoint)
+    # - idle connections are kept alive and re-used by subsequent queries to the same pod
+    #
+    adapter = HTTPAdapter(pool_connections=HTTP_POOLS, pool_maxsize=HTTP_POOL_SIZE)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    return session
+
+#: Process-wide HTTP session used to talk to the pods.
+http = _http()
+
+
+class Registry(object):
+    """
+    In-memory snapshot of the pods registered under ROOT/<cluster>/pods, kept current by kazoo watches. Once a
+    registry is attached to a client lookup() will resolve pods from memory instead of walking zookeeper. The
+    snapshot is primed synchronously upon construction and then only changes when pods register, update their
+    hints or go away.
+    """
+
+    def __init__(self, zk):
+
+        self.clusters = {}
+        self.lock = RLock()
+        self.stopped = 0
+        self.zk = zk
+
+        #
+        # - the watches will invoke _clusters() right away (e.g the snapshot is complete once we return)
+        #
+        self._arm(ROOT, self._clusters, lambda: True)
+        registries[zk] = self
+
+    def stop(self):
+
+        #
+        # - unregister and flag the registry as dead
+        # - any watch firing from now on will return False (which un-registers it)
+        #
+        with self.lock:
+            self.stopped = 1
+            registries.pop(self.zk, None)
+
+    def snapshot(self):
+
+        with self.lock:
+            return [(cluster, kid, dict(hints)) for cluster, pods in self.clusters.items()
+                    for kid, hints in pods.items() if hints]
+
+    def _clusters(self, clusters):
+
+        with self.lock:
+            if self.stopped:
+                return False
+
+            _bump()
+            for cluster in set(self.clusters) - set(clusters):
+                del self.clusters[cluster]
+
+            for cluster in set(clusters) - set(self.clusters):
+                self.clusters[cluster] = {}
+                self._watch(cluster, self.clusters[cluster])
+
+    def _arm(self, path, func, valid):
+
+        armed = [0]
+
+        def _exists(_, stat):
+
+            with self.lock:
+                if self.stopped or not valid():
+                    return False
+
+                #
+                # - kazoo's children watch gives up for good if the node is missing, which happens for instance
+                #   when a cluster znode shows up before its pods node
+                # - watch the node itself and arm the children watch once it exists (and again if re-created)
+                #
+                if stat is None:
+                    armed[0] = 0
+
+                elif not armed[0]:
+                    armed[0] = 1
+                    ChildrenWatch(self.zk, path, func)
+
+        DataWatch(self.zk, path, _exists)
+
+    def _watch(self, cluster, pods):
+
+        def _kids(kids):
+
+            with self.lock:
+
+                #
+                # - the cluster may have been removed (or removed and re-created) in the meantime
+                # - in that case our dict is orphaned : stop watching
+                #
+                if self.stopped or self.clusters.get(cluster) is not pods:
+                    return False
+
+                _bump()
+                for kid in set(pods) - set(kids):
+                    del pods[kid]
+
+                for kid in set(kids) - set(pods):
+                    pods[kid] = None
+                    self._hints(cluster, pods, kid)
+
+        self._arm('%s/%s/pods' % (ROOT, cluster), _kids, lambda: self.clusters.get(cluster) is pods)
+
+    def _hints(self, cluster, pods, kid):
+
+        def _data(js, _):
+
+            with self.lock:
+                if self.stopped or self.clusters.get(cluster) is not pods or kid not in pods:
+                    return False
+
+                _bump()
+                if js is None:
+
+                    #
+                    # - the pod znode is gone (the children watch will catch up shortly)
+                    #
+                    del pods[kid]
+                    return False
+
+                try:
+                    hints = \
+                        {
+                            'id': kid,
+                            'cluster': cluster
+                        }
+
+                    hints.update(json.loads(js))
+                    pods[kid] = hints
+
+                except ValueError:
+
+                    logger.debug('registry -> invalid hints @ %s/%s' % (cluster, kid))
+
+        DataWatch(self.zk, '%s/%s/pods/%s' % (ROOT, cluster, kid), _data)
+
+
+def _bump():
+
+    global _generation
+    _generation += 1
+
+
+def generation():
+    """
+    Returns a counter bumped whenever a pod registers, updates its hints or goes away (as seen by the registries).
+    Anything derived from the pods (e.g cached command outputs) is stale once this value changes.
+    """
+
+    return _generation
+
+
+def lookup(zk, regex, subset=None, pipelined=None):
 
     pods = {}
     ts = time.time()
+    if zk in registries:
+
+        #
+        # - we have a registry attached to this client, use its snapshot
+        # - no round-trip to zookeeper needed
+        #
+        for cluster, _, hints in registries[zk].snapshot():
+            if fnmatch.fnmatch(cluster, regex):
+                seq = hints['seq']
+                if not subset or seq in subset:
+                    pods['%s #%d' % (cluster, seq)] = hints
+
+        lapse = time.time() - ts
+        metrics.LOOKUP_SECONDS.observe(lapse, source='registry')
+        trace.record('lookup', 'zookeeper', ts, lapse, source='registry', pods=len(pods))
+        logger.debug('<- registry (%d pods, %.2f ms)' % (len(pods), 1000 * lapse))
+        return pods
+
+    reads = []
+    clusters = []
+    trips = 1
+    if pipelined is None:
+        pipelined = PIPELINED
+
     try:
         #
         # - use a glob style regex to match the cluster (handy to retrieve multiple
         #   clusters at once)
         #
         clusters = [cluster for cluster in zk.get_children(ROOT) if fnmatch.fnmatch(cluster, regex)]
-        for cluster in clusters:
-            kids = zk.get_children('%s/%s/pods' % (ROOT, cluster))
-            for kid in kids:
-                js, _ = zk.get('%s/%s/pods/%s' % (ROOT, cluster, kid))
-                hints = \
-                    {
-                        'id': kid,
-                        'cluster': cluster
-                    }
+        if pipelined:
 
-                #
-                # - the number displayed by the tools (e.g shared.docker-proxy #4) is that monotonic integer
-                #   derived from zookeeper
-                #
-                hints.update(json.loads(js))
-                seq = hints['seq']
-                if not subset or seq in subset:
-                    pods['%s #%d' % (cluster, seq)] = hints
+            #
+            # - issue all the reads at once via the kazoo async API and gather the results
+            # - we'll pay one round-trip per tree level instead of one per pod
+            # - a znode going away in the meantime is simply skipped
+            #
+            latches = [(cluster, zk.get_children_async('%s/%s/pods' % (ROOT, cluster))) for cluster in clusters]
+            pending = []
+            for cluster, latch in latches:
+                try:
+                    kids = latch.get()
+                    pending += [(cluster, kid, zk.get_async('%s/%s/pods/%s' % (ROOT, cluster, kid))) for kid in kids]
+
+                except NoNodeError:
+                    pass
+
+            for cluster, kid, latch in pending:
+                try:
+                    js, _ = latch.get()
+                    reads.append((cluster, kid, js))
+
+                except NoNodeError:
+                    pass
+
+            trips += (1 if latches else 0) + (1 if pending else 0)
+
+        else:
+
+            for cluster in clusters:
+                kids = zk.get_children('%s/%s/pods' % (ROOT, cluster))
+                for kid in kids:
+                    js, _ = zk.get('%s/%s/pods/%s' % (ROOT, cluster, kid))
+                    reads.append((cluster, kid, js))
 
     except NoNodeError:
         pass
 
-    ms = 1000 * (time.time() - ts)
-    logger.debug('<- zookeeper (%d pods, %d ms)' % (len(pods), int(ms)))
+    for cluster, kid, js in reads:
+        hints = \
+            {
+                'id': kid,
+                'cluster': cluster
+            }
+
+        #
+        # - the number displayed by the tools (e.g shared.docker-proxy #4) is that monotonic integer
+        #   derived from zookeeper
+        #
+        hints.update(json.loads(js))
+        seq = hints['seq']
+        if not subset or seq in subset:
+            pods['%s #%d' % (cluster, seq)] = hints
+
+    lapse = time.time() - ts
+    metrics.LOOKUP_SECONDS.observe(lapse, source='zookeeper')
+    trace.record('lookup', 'zookeeper', ts, lapse, source='zookeeper', pods=len(pods), trips=trips)
+    ms = 1000 * lapse
+    if pipelined:
+
+        #
+        # - report how many round-trips the serial walk would have cost (e.g the expected speedup)
+        #
+        serial = 1 + len(clusters) + len(reads)
+        logger.debug('<- zookeeper (%d pods, %d ms, %d round-trips instead of %d, x%.1f)' %
+                     (len(pods), int(ms), trips, serial, float(serial) / trips))
+    else:
+        logger.debug('<- zookeeper (%d pods, %d ms)' % (len(pods), int(ms)))
     return pods
 
 
-def fire(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None):
+def scatter(pods, command, timeout=5.0, js=None, headers=None, files=None, engine=None, deadline=None, hedge=None):
+    """
+    Fires a HTTP POST /<command> at each pod (as returned by lookup()) and yields (key, seq, body, code, status)
+    tuples as the queries complete. The status is either 'ok', 'timeout' or 'i/o error' (code being None for pods
+    that did not reply). The queries are either run on our fan-out pool or multiplexed on the shared event loop
+    depending on the engine.
 
-    class _Post(Thread):
-        """
-        We optimize a bit the HTTP queries to the pods by running them on separate threads (this can be a
-        tad slow otherwise for more than 10 queries in a row)
-        """
+    The optional deadline (in seconds) bounds the whole fan-out : any pod that did not reply by then is reported as
+    'timeout'. If hedge is set to a percentile (e.g 0.9) the query is re-sent once to each straggler as soon as that
+    fraction of the pods has replied (the first reply wins). Only hedge idempotent commands (info, log, etc.) !
+
+    Whatever query is not sent yet once we are done (deadline reached or the caller stopped iterating) is dropped,
+    which keeps it from holding the shared fan-out pool. When using the thread pool at most FANOUT_CALL queries are
+    in flight at any time, leaving room for the other commands running within the process.
+    """
 
-        def __init__(self, key, hints):
-            super(_Post, self).__init__()
+    fifo = Queue()
+    cancel = Event()
+    engine = engine or ENGINE
+    assert engine in ['threads', 'events'], 'invalid fan-out engine "%s"' % engine
+    assert hedge is None or 0.0 < hedge < 1.0, 'the hedging percentile must be within ]0, 1['
 
-            self.key = key
-            self.hints = hints
-            self.body = None
-            self.code = None
+    #
+    # - the queries are queued and then sent as the previous ones complete (the event loop has no such limit)
+    # - busy is the number of queries sent for which we did not get anything back yet
+    #
+    busy = [0]
+    backlog = deque()
+
+    def _send(key, hints):
+        backlog.append((key, hints))
 
-            self.start()
+    def _pump():
+        while backlog and (engine == 'events' or busy[0] < FANOUT_CALL):
+            key, hints = backlog.popleft()
+            busy[0] += 1
+            if engine == 'events':
+                _schedule(fifo, key, hints, command, timeout, js, headers, files, cancel)
+            else:
+                fanout.submit(_post, fifo, key, hints, command, timeout, js, headers, files, cancel)
 
-        def run(self):
+    #
+    # - keep track of how many queries are in flight for each pod
+    # - a pod is settled upon its first reply or once all its queries failed
+    #
+    ts = time.time()
+    inflight = {key: 1 for key in pods}
+    metrics.FANOUT_PODS.observe(len(pods), command=command)
+    for key, hints in pods.items():
+        _send(key, hints)
 
-            url = 'N/A'
+    _pump()
+    hedged = 0
+    threshold = len(pods) * hedge if hedge else None
+    try:
+        while inflight:
             try:
-                ts = time.time()
-                port = self.hints['port']
-                assert port in self.hints['ports'], 'ochopod control port not exposed @ %s (user error ?)' % self.key
-                url = 'http://%s:%d/%s' % (self.hints['ip'], self.hints['ports'][port], command)
-                reply = requests.post(url, timeout=timeout, data=js, headers=headers, files=files)
-                self.body = reply.json()
-                self.code = reply.status_code
-                ms = 1000 * (time.time() - ts)
-                logger.debug('-> %s (HTTP %d, %s ms)' % (url, reply.status_code, int(ms)))
-
-            except HTTPTimeout:
-                logger.debug('-> %s (timeout)' % url)
+                if deadline is None:
+                    key, seq, body, code, status = fifo.get()
+                else:
+                    key, seq, body, code, status = fifo.get(timeout=max(0.0, ts + deadline - time.time()))
 
-            except Exception as failure:
-                logger.debug('-> %s (i/o error, %s)' % (url, failure))
+            except Empty:
+
+                #
+                # - we hit the deadline, report all the pending pods as timed out
+                # - whatever they reply later on will be ignored
+                #
+                logger.debug('-> fan-out deadline reached (%d pods pending)' % len(inflight))
+                for key in inflight.keys():
+                    yield key, pods[key]['seq'], None, None, 'timeout'
+                return
+
+            busy[0] -= 1
+            _pump()
+            if key not in inflight:
+                continue
+
+            inflight[key] -= 1
+            if code or not inflight[key]:
+                del inflight[key]
+                yield key, seq, body, code, status
 
-        def join(self, timeout=None):
+            if threshold is not None and not hedged and len(pods) - len(inflight) >= threshold:
 
-            Thread.join(self)
-            return self.key, self.hints['seq'], self.body, self.code
+                #
+                # - enough pods replied, re-send the query to the stragglers
+                #
+                hedged = 1
+                logger.debug('-> hedging %d pods' % len(inflight))
+                for key in inflight.keys():
+                    inflight[key] += 1
+                    _send(key, pods[key])
+
+                _pump()
+
+    finally:
+
+        #
+        # - drop the queries still queued (nobody will read their reply)
+        # - the caller may stop iterating early (in which case we only account for what it waited for)
+        #
+        cancel.set()
+        metrics.FANOUT_SECONDS.observe(time.time() - ts, command=command)
+        trace.record('fan-out', 'pods', ts, time.time() - ts, command=command, engine=engine, pods=len(pods), hedged=hedged)
+
+
+def stream(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, engine=None, deadline=None, hedge=None):
+    """
+    Generator flavor of fire() yielding (key, seq, body, code) for each pod as soon as its reply comes in. The
+    caller may stop iterating at any time (the queries in flight will complete in the background, the ones not sent
+    yet are dropped).
+    """
 
     #
     # - lookup our pods based on the cluster(s) we want
-    # - fire a thread for each
+    # - fan the HTTP queries out and relay the replies in the order they come in
     #
     pods = lookup(zk, cluster, subset=subset)
-    threads = [_Post(pod, hints) for pod, hints in pods.items()]
-    out = [thread.join() for thread in threads]
-    return {key: (seq, body, code) for (key, seq, body, code) in out if code}
+    replies = scatter(pods, command, timeout=timeout, js=js, headers=headers, files=files, engine=engine, deadline=deadline, hedge=hedge)
+    for key, seq, body, code, _ in replies:
+        if code:
+            yield key, seq, body, code
+
+
+def survey(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, engine=None, deadline=None, hedge=None):
+    """
+    Variant of fire() reporting every pod : returns a {key: (seq, body, code, status)} dict, status being either
+    'ok', 'timeout' or 'i/o error'.
+    """
+
+    pods = lookup(zk, cluster, subset=subset)
+    replies = scatter(pods, command, timeout=timeout, js=js, headers=headers, files=files, engine=engine, deadline=deadline, hedge=hedge)
+    return {key: (seq, body, code, status) for (key, seq, body, code, status) in replies}
+
+
+def fire(zk, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, engine=None, deadline=None, hedge=None):
+
+    replies = stream(zk, cluster, command, subset=subset, timeout=timeout, js=js, headers=headers, files=files, engine=engine, deadline=deadline, hedge=hedge)
+    return {key: (seq, body, code) for (key, seq, body, code) in replies}
+
+
+def _url(key, hints, command):
+
+    port = hints['port']
+    assert port in hints['ports'], 'ochopod control port not exposed @ %s (user error ?)' % key
+    return 'http://%s:%d/%s' % (hints['ip'], hints['ports'][port], command)
+
+
+def _post(fifo, key, hints, command, timeout, js, headers, files, cancel):
+
+    #
+    # - the fan-out may be over by the time we get a thread (see scatter())
+    #
+    if cancel.is_set():
+        return
+
+    url = 'N/A'
+    body = None
+    code = None
+    status = 'ok'
+    ts = time.time()
+    try:
+        url = _url(key, hints, command)
+        reply = http.post(url, timeout=timeout, data=js, headers=headers, files=files)
+        body = reply.json()
+        code = reply.status_code
+        lapse = time.time() - ts
+        metrics.POD_SECONDS.observe(lapse, cluster=hints.get('cluster', ''), command=command)
+        logger.debug('-> %s (HTTP %d, %s ms)' % (url, reply.status_code, int(1000 * lapse)))
+
+    except HTTPTimeout:
+        status = 'timeout'
+        logger.debug('-> %s (timeout)' % url)
+
+    except Exception as failure:
+        status = 'i/o error'
+        logger.debug('-> %s (i/o error, %s)' % (url, failure))
+
+    if code is None:
+        metrics.POD_FAILURES.inc(cluster=hints.get('cluster', ''), command=command, status=status)
+
+    trace.record('POST /%s' % command, 'pods', ts, time.time() - ts, pod=key, url=url, code=code, status=status)
+    fifo.put((key, hints['seq'], body, code, status))
+
+
+def _schedule(fifo, key, hints, command, timeout, js, headers, files, cancel):
+
+    url = 'N/A'
+    ts = time.time()
+
+    def _done(body, code, failure):
+
+        #
+        # - invoked from the event loop thread
+        # - the fan-out may be over before the loop admitted our request (see scatter())
+        #
+        if failure == 'cancelled':
+            return
+
+        elif failure == 'timeout':
+            logger.debug('-> %s (timeout)' % url)
+
+        elif failure is not None:
+            logger.debug('-> %s (i/o error, %s)' % (url, failure))
+
+        else:
+            lapse = time.time() - ts
+            metrics.POD_SECONDS.observe(lapse, cluster=hints.get('cluster', ''), command=command)
+            logger.debug('-> %s (HTTP %d, %s ms)' % (url, code, int(1000 * lapse)))
+
+        status = 'ok' if failure is None else ('timeout' if failure == 'timeout' else 'i/o error')
+        trace.record('POST /%s' % command, 'pods', ts, time.time() - ts, pod=key, url=url, code=code, status=status)
+        if failure is None:
+            fifo.put((key, hints['seq'], body, code, status))
+        else:
+            metrics.POD_FAILURES.inc(cluster=hints.get('cluster', ''), command=command, status=status)
+            fifo.put((key, hints['seq'], None, None, status))
+
+    try:
+        url = _url(key, hints, command)
+        loop.shared().submit(url, data=js, headers=headers, files=files, timeout=timeout, callback=_done, cancel=cancel)
+
+    except Exception as failure:
+
+        _done(None, None, failure)
+
+
+class Locks(object):
+    """
+    Zookeeper locks serializing the mutating operations (deploy, scale, etc.) across portals, one per cluster. Globs
+    are resolved against the clusters currently registered. The locks are acquired in order (which rules out
+    dead-locks) and held until release() is called, or until the block exits when used as a context manager.
+    """
+
+    def __init__(self, proxy, clusters, timeout=60.0):
+
+        def _create(zk):
+            names = set()
+            for cluster in clusters:
+                if any(c in cluster for c in '*?['):
+                    try:
+                        names |= set(name for name in zk.get_children(ROOT) if fnmatch.fnmatch(name, cluster))
+
+                    except NoNodeError:
+                        pass
+                else:
+                    names.add(cluster)
+
+            identifier = '%s (%d)' % (socket.gethostname(), os.getpid())
+            return [zk.Lock('%s/%s' % (LOCKS, name), identifier) for name in sorted(names)]
+
+        self.held = []
+        for lock in run(proxy, _create):
+            try:
+                with trace.span('lock', 'zookeeper', path=lock.path):
+                    ts = time.time()
+                    lock.acquire(timeout=timeout)
+                    logger.debug('-> locked %s (%d ms)' % (lock.path, int(1000 * (time.time() - ts))))
+                    self.held.append(lock)
+
+            except LockTimeout:
+
+                self.release()
+                assert 0, '%s is being modified by another portal (timeout)' % lock.path.split('/')[-1]
+
+            except Exception:
+
+                #
+                # - anything else (connection loss, read-only server, etc.) : release what we hold and re-raise
+                # - nobody would release it otherwise (the caller never gets hold of us)
+                #
+                self.release()
+                raise
+
+    def release(self):
+
+        while self.held:
+            lock = self.held.pop()
+            try:
+                lock.release()
+
+            except Exception as failure:
+
+                logger.warning('unable to release %s (%s)' % (lock.path, diagnostic(failure)))
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *_):
+
+        self.release()
+
+
+class Arrivals(object):
+    """
+    Watches ROOT/<cluster>/pods and keeps track of the pods registered there, optionally only the ones whose hints
+    pass the specified filter (e.g the pods of a given marathon application). The cluster does not have to exist
+    yet. The watches are armed upon construction and dropped by stop(), or when the block exits when used as a
+    context manager. wait() blocks until a pod registers or goes away, which lets the caller react to new pods as
+    soon as their znode shows up instead of polling zookeeper.
+    """
+
+    def __init__(self, proxy, cluster, match=None):
+
+        self.armed = 0
+        self.cluster = cluster
+        self.event = Event()
+        self.kids = {}
+        self.lock = RLock()
+        self.match = match
+        self.path = '%s/%s/pods' % (ROOT, cluster)
+        self.stopped = 0
+
+        def _arm(zk):
+
+            #
+            # - watch the pods node itself first (it is only created when the first pod registers)
+            # - the children watch is armed as soon as it exists
+            #
+            self.zk = zk
+            DataWatch(zk, self.path, self._exists)
+
+        run(proxy, _arm)
+
+    def stop(self):
+
+        #
+        # - any watch firing from now on will return False (which un-registers it)
+        #
+        with self.lock:
+            self.stopped = 1
+            self.event.set()
+
+    def snapshot(self):
+        """
+        Returns the pods matching our filter as a {key: hints} dict (see lookup()).
+        """
+
+        with self.lock:
+            return {'%s #%d' % (self.cluster, hints['seq']): dict(hints) for hints in self.kids.values() if hints}
+
+    def wait(self, timeout):
+        """
+        Blocks until something changed since the last call or until the timeout (in seconds) is reached. Returns
+        True if something changed.
+        """
+
+        fired = self.event.wait(timeout)
+        self.event.clear()
+        return fired
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *_):
+
+        self.stop()
+
+    def _exists(self, _, stat):
+
+        with self.lock:
+            if self.stopped:
+                return False
+
+            #
+            # - the pods node went away : re-arm once it is re-created (kazoo stops the children watch on its own)
+            #
+            if stat is None:
+                self.armed = 0
+
+            elif not self.armed:
+                self.armed = 1
+                ChildrenWatch(self.zk, self.path, self._kids)
+
+    def _kids(self, kids):
+
+        with self.lock:
+            if self.stopped:
+                return False
+
+            for kid in set(self.kids) - set(kids):
+                del self.kids[kid]
+
+            for kid in set(kids) - set(self.kids):
+
+                #
+                # - read the hints once (the ones we care about do not change over the pod lifetime)
+                # - pods failing our filter are remembered as None
+                #
+                self.kids[kid] = None
+                try:
+                    js, _ = self.zk.get('%s/%s' % (self.path, kid))
+                    hints = \
+                        {
+                            'id': kid,
+                            'cluster': self.cluster
+                        }
+
+                    hints.update(json.loads(js))
+                    if self.match is None or self.match(hints):
+                        self.kids[kid] = hints
+
+                except NoNodeError:
+                    pass
+
+                except ValueError:
+
+                    logger.debug('arrivals -> invalid hints @ %s/%s' % (self.cluster, kid))
+
+            self.event.set()
+
+
+class Session(object):
+    """
+    Long-lived zookeeper proxy meant to be shared by all the tool invocations within a process (typically the
+    portal). The underlying client re-connects automatically and the session keeps track of its health. The
+    watch-backed registry is enabled by default.
+    """
+
+    def __init__(self, brokers, registry=True):
+
+        self.lock = Lock()
+        self.state = \
+            {
+                'connected': False,
+                'since': time.time(),
+                'connections': 0,
+                'losses': 0
+            }
+
+        self.proxy = ZK.start(brokers, registry=registry, session=self)
+
+    def feedback(self, state):
+
+        #
+        # - invoked from the kazoo thread upon each connection state change
+        #
+        with self.lock:
+            connected = state == KazooState.CONNECTED
+            if connected != self.state['connected']:
+                self.state['connected'] = connected
+                self.state['since'] = time.time()
+                if connected:
+                    self.state['connections'] += 1
+
+            if state == KazooState.LOST:
+                self.state['losses'] += 1
+
+    def health(self):
+
+        with self.lock:
+            js = dict(self.state)
+
+        #
+        # - report for how long (in seconds) we have been connected or disconnected
+        # - any connection past the first one is a re-connection
+        #
+        js['for'] = int(time.time() - js.pop('since'))
+        js['reconnections'] = max(0, js.pop('connections') - 1)
+        return js
+
+    def stop(self):
+
+        shutdown(self.proxy)
+
+
+#: Process-wide shared session (see attach()).
+_session = None
+
+
+def attach(brokers, registry=True):
+    """
+    Starts a process-wide shared zookeeper session. Tools run from within that process will use it instead of
+    spinning their own proxy up (and tearing it down) each time.
+    """
+
+    global _session
+    assert _session is None, 'a shared session is already attached'
+    _session = Session(brokers, registry=registry)
+    return _session
+
+
+def detach():
+
+    global _session
+    if _session is not None:
+        _session.stop()
+        _session = None
+
+
+def session():
+    """
+    Returns the shared session if any was attached, None otherwise.
+    """
+
+    return _session
 
 
 def run(proxy, func, timeout=None):
     """
     Helper asking the zookeeper proxy actor to run the specified closure and blocking until either the timeout is
-    reached or a response is received.
+    reached or a response is received. Keep the closure short (e.g a lookup()) : anything slow it does (like firing
+    HTTP requests at the pods) holds one of the executor threads that every tool in the process queues on.
     """
 
     try:
-        latch = pykka.ThreadingFuture()
-        proxy.tell(
-            {
-                'request': 'execute',
-                'latch': latch,
-                'function': func
-            })
-        Event()
-        out = latch.get(timeout=timeout)
+        with trace.span('run', 'zookeeper', closure=func.__name__):
+            latch = pykka.ThreadingFuture()
+            proxy.tell(
+                {
+                    'request': 'execute',
+                    'latch': latch,
+                    'function': func
+                })
+            Event()
+            out = latch.get(timeout=timeout)
+
         if isinstance(out, Exception):
             raise out
 
@@ -153,25 +919,35 @@ def run(proxy, func, timeout=None):
 
 class ZK(FSM):
     """
-    Small actor maintaining a read-only zookeeper client and able to run closures (to run arbitrary lookup
-    queries). This is used by all our tools to retrieve information about the pods.
+    Small actor maintaining a zookeeper client and able to run closures (to run arbitrary lookup queries). This is
+    used by all our tools to retrieve information about the pods. The closures all share the same client and are
+    run concurrently on a bounded executor shared by the whole process : they should only talk to zookeeper and
+    leave the pod fan-outs to the calling thread (see toolset.tool.Context). The only writes are the cluster locks
+    (see Locks) and the portal job registrations, both of which fail if we are connected to a read-only server.
     """
 
-    def __init__(self, brokers, data={}):
+    def __init__(self, brokers, data={}, registry=False, session=None):
         super(ZK, self).__init__()
 
+        self.client = None
         self.connected = 0
         self.brokers = brokers
         self.data = data
         self.pending = deque()
         self.path = 'zookeeper proxy'
+        self.registry = registry
+        self.session = session
 
     def feedback(self, state):
 
         #
+        # - update the session health if any
         # - forward the state change to the actor via a message
         # - the specialized() hook will process this safely
         #
+        if self.session is not None:
+            self.session.feedback(state)
+
         self.actor_ref.tell(
             {
                 'request': 'state change',
@@ -180,6 +956,11 @@ class ZK(FSM):
 
     def reset(self, data):
 
+        self.client = None
+        if hasattr(data, 'registry'):
+            data.registry.stop()
+            del data.registry
+
         if hasattr(data, 'zk'):
             data.zk.stop()
             data.zk.close()
@@ -196,6 +977,7 @@ class ZK(FSM):
             #
             self.exitcode()
 
+        data.ts = time.time()
         cnx_string = ','.join(self.brokers)
         data.zk = KazooClient(hosts=cnx_string, timeout=30.0, read_only=1, randomize_hosts=1)
         data.zk.add_listener(self.feedback)
@@ -211,6 +993,15 @@ class ZK(FSM):
         if not self.connected:
             return 'wait_for_cnx', data, 1.0
 
+        trace.record('connect', 'zookeeper', data.ts, time.time() - data.ts)
+
+        #
+        # - optionally prime our watch-backed registry
+        # - lookup() will then resolve pods from memory
+        #
+        if self.registry and not hasattr(data, 'registry'):
+            data.registry = Registry(data.zk)
+
         return 'spin', data, 0
 
     def spin(self, data):
@@ -218,17 +1009,29 @@ class ZK(FSM):
         if self.terminate:
             raise Aborted('terminating')
 
+        #
+        # - drain whatever was queued while we were connecting
+        # - from now on closures are run as soon as they are received (see specialized())
+        # - we keep on spinning to catch the termination request
+        #
         while len(self.pending) > 0:
+            self.execute(self.pending.popleft(), data.zk)
+
+        self.client = data.zk
+        return 'spin', data, 0.25
+
+    def execute(self, msg, zk):
+
+        def _run():
 
             out = None
-            msg = self.pending.popleft()
             try:
 
                 #
                 # - run the specified closure
                 # - assign the latch to whatever is returned
                 #
-                out = msg['function'](data.zk)
+                out = msg['function'](zk)
 
             except Exception as failure:
 
@@ -240,7 +1043,11 @@ class ZK(FSM):
 
             msg['latch'].set(out)
 
-        return 'spin', data, 0.25
+        #
+        # - the closures are run on our bounded executor (and not on the actor thread)
+        # - this way multiple tool threads (e.g one per cluster) can block on i/o concurrently
+        #
+        executor.submit(_run)
 
     def specialized(self, msg):
 
@@ -258,9 +1065,13 @@ class ZK(FSM):
         elif req == 'execute':
 
             #
-            # - request to run some code, append to our FIFO
+            # - request to run some code
+            # - run it right away if we are connected, otherwise append to our FIFO
             #
-            self.pending.append(msg)
+            if self.client is not None and not self.terminate:
+                self.execute(msg, self.client)
+            else:
+                self.pending.append(msg)
 
         else:
             super(ZK, self).specialized(msg)
\ No newline at end of file
@@ -0,0 +1,294 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import errno
+import fcntl
+import heapq
+import json
+import logging
+import os
+import select
+import socket
+import time
+
+from collections import deque
+from itertools import count
+from requests import Request
+from threading import Lock, Thread
+from urlparse import urlparse
+
+#: Our ochopod logger.
+logger = logging.getLogger('ochopod')
+
+#: Readiness flags (the epoll and poll masks are identical on linux).
+IN = select.POLLIN | select.POLLPRI
+OUT = select.POLLOUT
+BAD = select.POLLERR | select.POLLHUP
+
+#: Lazily started process-wide loop (see shared()).
+_shared = None
+
+#: Lock protecting the creation of the shared loop.
+_lock = Lock()
+
+
+def shared():
+    """
+    Returns the process-wide event loop, starting it upon the first invocation.
+    """
+
+    global _shared
+    with _lock:
+        if _shared is None:
+            _shared = Loop()
+
+    return _shared
+
+
+class _Request(object):
+
+    def __init__(self, url, host, port, raw, timeout, callback, cancel):
+
+        self.callback = callback
+        self.cancel = cancel
+        self.chunks = []
+        self.deadline = time.time() + timeout
+        self.done = 0
+        self.host = host
+        self.out = raw
+        self.port = port
+        self.sock = None
+        self.url = url
+
+
+class Loop(Thread):
+    """
+    Minimalistic HTTP client multiplexing any number of queries over epoll (or poll if epoll is not available)
+    from one single daemon thread. Requests are queued via submit() and the specified callback is invoked from the
+    loop thread once the reply is in, the request timed out or an i/o error occurred. The callback must therefore
+    return quickly.
+
+    The requests are issued as HTTP/1.0 (e.g the connection is closed by the pod once the reply is sent) and the
+    timeout applies to the whole exchange.
+    """
+
+    def __init__(self):
+        super(Loop, self).__init__()
+
+        self.daemon = True
+        self.incoming = deque()
+        self.live = {}
+        self.seq = count()
+        self.timers = []
+
+        #
+        # - the pipe is used to wake the loop up whenever a new request is queued
+        #
+        self.r, self.w = os.pipe()
+        for fd in [self.r, self.w]:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.epoll = hasattr(select, 'epoll')
+        self.poller = select.epoll() if self.epoll else select.poll()
+        self.poller.register(self.r, IN)
+
+        self.start()
+
+    def submit(self, url, data=None, headers=None, files=None, timeout=5.0, callback=None, cancel=None):
+        """
+        Queues a HTTP POST. The callback is invoked with (body, code, failure), failure being either None, 'timeout',
+        'cancelled' or the i/o error that occurred. The request is dropped without being sent if the optional cancel
+        event is set by the time the loop picks it up.
+        """
+
+        #
+        # - let requests do the encoding work for us (json, multi-part uploads, etc.)
+        # - we then serialize the request verbatim
+        #
+        prepared = Request('POST', url, data=data, headers=headers, files=files).prepare()
+        body = prepared.body or ''
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        parsed = urlparse(url)
+        lines = ['POST %s HTTP/1.0' % prepared.path_url, 'Host: %s' % parsed.netloc, 'Content-Length: %d' % len(body)]
+        lines += ['%s: %s' % (key, value) for key, value in prepared.headers.items() if key.lower() != 'content-length']
+        raw = '\r\n'.join(lines) + '\r\n\r\n' + body
+
+        self.incoming.append(_Request(url, parsed.hostname, parsed.port or 80, raw, timeout, callback, cancel))
+        try:
+            os.write(self.w, '!')
+
+        except OSError as failure:
+
+            #
+            # - the pipe is full, meaning the loop has plenty of wake-ups pending already
+            #
+            if failure.errno != errno.EAGAIN:
+                raise
+
+    def run(self):
+
+        while 1:
+
+            #
+            # - expire whatever request is past its deadline
+            # - then wait for i/o events until the next deadline (at most 1 second)
+            #
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, req = heapq.heappop(self.timers)
+                if not req.done:
+                    self._close(req, None, None, 'timeout')
+
+            lapse = max(0.0, min(1.0, self.timers[0][0] - now)) if self.timers else 1.0
+            try:
+                events = self.poller.poll(lapse) if self.epoll else self.poller.poll(int(lapse * 1000))
+
+            except (IOError, OSError, select.error) as failure:
+                if failure.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            wake = 0
+            for fd, mask in events:
+
+                if fd == self.r:
+                    wake = 1
+                    continue
+
+                req = self.live.get(fd)
+                if req is None:
+                    continue
+
+                try:
+                    if req.out is not None and mask & (OUT | BAD):
+                        self._send(req)
+
+                    elif mask & (IN | BAD):
+                        self._recv(req)
+
+                except Exception as failure:
+
+                    self._close(req, None, None, failure)
+
+            #
+            # - admit new requests only once the batch is processed (file descriptors closed above may be
+            #   re-used and we don't want to match them with stale events)
+            #
+            if wake:
+                self._admit()
+
+    def _admit(self):
+
+        try:
+            while os.read(self.r, 4096):
+                pass
+
+        except OSError:
+            pass
+
+        while self.incoming:
+            req = self.incoming.popleft()
+            if req.cancel is not None and req.cancel.is_set():
+                self._close(req, None, None, 'cancelled')
+                continue
+
+            try:
+                req.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                req.sock.setblocking(0)
+                code = req.sock.connect_ex((req.host, req.port))
+                if code not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+                    raise socket.error(code, os.strerror(code))
+
+                fd = req.sock.fileno()
+                self.live[fd] = req
+                self.poller.register(fd, OUT)
+                heapq.heappush(self.timers, (req.deadline, next(self.seq), req))
+
+            except Exception as failure:
+
+                self._close(req, None, None, failure)
+
+    def _send(self, req):
+
+        code = req.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            raise socket.error(code, os.strerror(code))
+
+        sent = req.sock.send(req.out)
+        req.out = req.out[sent:]
+        if not req.out:
+
+            #
+            # - the request is out, switch to reading
+            #
+            req.out = None
+            self.poller.modify(req.sock.fileno(), IN)
+
+    def _recv(self, req):
+
+        chunk = req.sock.recv(65536)
+        if chunk:
+            req.chunks.append(chunk)
+            return
+
+        #
+        # - the pod closed the connection (HTTP/1.0), we have the whole reply
+        # - parse the status line and decode the json body
+        #
+        raw = ''.join(req.chunks)
+        head, _, body = raw.partition('\r\n\r\n')
+        lines = head.split('\r\n')
+        tokens = lines[0].split(' ')
+        assert len(tokens) > 1 and tokens[0].startswith('HTTP/'), 'invalid HTTP reply'
+        code = int(tokens[1])
+        headers = dict((key.strip().lower(), value.strip()) for key, _, value in [line.partition(':') for line in lines[1:]])
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = _unchunk(body)
+
+        self._close(req, json.loads(body), code, None)
+
+    def _close(self, req, body, code, failure):
+
+        req.done = 1
+        if req.sock is not None:
+            fd = req.sock.fileno()
+            if fd in self.live:
+                del self.live[fd]
+                self.poller.unregister(fd)
+            req.sock.close()
+
+        try:
+            req.callback(body, code, failure)
+
+        except Exception as failure:
+
+            logger.debug('-> %s (callback failure, %s)' % (req.url, failure))
+
+
+def _unchunk(body):
+
+    out = []
+    while body:
+        size, _, body = body.partition('\r\n')
+        n = int(size.split(';')[0], 16)
+        if not n:
+            break
+        out.append(body[:n])
+        body = body[n + 2:]
+
+    return ''.join(out)
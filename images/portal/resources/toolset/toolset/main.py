@@ -14,61 +14,265 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import imp
+import importlib
 import logging
 import sys
 
 from argparse import ArgumentParser
-from os import listdir
-from os.path import dirname, isfile, join
+from collections import deque
+from contextlib import contextmanager
+from logging import INFO
+from os.path import dirname, join
 from ochopod.core.fsm import diagnostic
-from toolset.tool import Template
+from threading import Condition, current_thread, RLock
+from toolset import manifest
+from toolset.tool import Isolated, Template
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
+#: Tag -> script index, built once per process (see index()).
+_index = None
 
-def go():
+#: Tools imported so far, indexed by tag (see pick()).
+_tools = {}
+
+#: Lock protecting the index & imports.
+_lock = RLock()
+
+
+class _Router(logging.Handler):
     """
-    Entry point for the portal tool-set. This script will look for python modules in the /commands sub-directory. This
-    is what is invoked from within the portal's flask endpoint (e.g when the user types something in the cli)
+    Logging handler routing whatever a thread logs to the list it has been bound to. This is how we capture the
+    output of tools running in-process (e.g from within the portal) while serving concurrent requests.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, level=INFO)
+
+        self.sinks = {}
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record):
+
+        sink = self.sinks.get(record.thread)
+        if sink is not None:
+            sink.extend(self.format(record).split('\n'))
+
+
+#: Lazily installed output router (see capture()).
+_router = None
+
+
+class _Uncaptured(logging.Filter):
+    """
+    Filter keeping a handler from emitting whatever is being captured (see capture()).
     """
 
+    def filter(self, record):
+
+        return _router is None or record.thread not in _router.sinks
+
+
+def uncaptured(*loggers):
+    """
+    Keeps the handlers currently attached to the specified loggers from emitting whatever is being captured (see
+    capture()). Call it once the console handlers are in place, otherwise captured outputs show up there as well.
+    """
+
+    for log in loggers:
+        for handler in log.handlers:
+            if not isinstance(handler, _Router):
+                handler.addFilter(_Uncaptured())
+
+
+class Output(object):
+    """
+    Thread-safe line buffer execute() can write to while another thread consumes it via drain(). Lines are dropped
+    once consumed, which keeps the memory footprint flat whatever the amount of output. Call discard() if the
+    consumer goes away.
+    """
+
+    def __init__(self):
+
+        self.code = None
+        self.condition = Condition()
+        self.discarded = False
+        self.done = False
+        self.lines = deque()
+
+    def extend(self, lines):
+
+        with self.condition:
+            if not self.discarded:
+                self.lines.extend(lines)
+                self.condition.notify_all()
+
+    def discard(self):
+        """
+        Drops whatever is buffered as well as any line coming next (e.g nobody will consume them). The exit code is
+        still set upon close().
+        """
+
+        with self.condition:
+            self.discarded = True
+            self.lines.clear()
+
+    def close(self, code):
+
+        with self.condition:
+            self.code = code
+            self.done = True
+            self.condition.notify_all()
+
+    def drain(self):
+        """
+        Yields the lines as they come until close() is invoked. The exit code is then available in the code attribute.
+        """
+
+        while 1:
+            with self.condition:
+                while not self.lines and not self.done:
+                    self.condition.wait()
+
+                if not self.lines:
+                    return
+
+                batch = list(self.lines)
+                self.lines.clear()
+
+            for line in batch:
+                yield line
+
+
+def _import(script):
+
     #
-    # - start by simplifying a bit the console logger to look more CLI-ish
+    # - import the script as a toolset.commands sub-module (its bytecode is cached as usual)
+    # - the module must have a go() callable returning the tool
+    # - the lock must be held
     #
-    for handler in logger.handlers:
-        handler.setFormatter(logging.Formatter('%(message)s'))
-
     try:
+        module = importlib.import_module('toolset.commands.%s' % script[:-3])
+        assert hasattr(module, 'go') and callable(module.go), 'go() undefined (invalid tool code ?)'
+        tool = module.go()
+        assert isinstance(tool, Template), 'wrong sub-class (invalid tool code ?)'
+        assert tool.tag, 'tag left undefined (invalid tool code ?)'
+        _tools[tool.tag] = tool
+        return tool
 
-        def _import(where, funcs):
-            try:
-                for script in [f for f in listdir(where) if isfile(join(where, f)) and f.endswith('.py')]:
-                    try:
-                        module = imp.load_source(script[:-3], join(where, script))
-                        if hasattr(module, 'go') and callable(module.go):
-                            tool = module.go()
-                            assert isinstance(tool, Template), 'wrong sub-class (invalid tool code ?)'
-                            assert tool.tag, 'tag left undefined (invalid tool code ?)'
-                            funcs[tool.tag] = tool
+    except Exception as failure:
+
+        logger.warning('failed to import %s (%s)' % (script, diagnostic(failure)))
+
+
+def index():
+    """
+    Returns the tools found in the /commands sub-directory as a {tag: script} dict, without importing them. This is
+    done once per process and relies on the manifest generated by setup.py. The directory is re-scanned if the
+    manifest is missing or stale (in which case we attempt to refresh it).
+    """
 
-                    except Exception as failure:
+    global _index
+    with _lock:
+        if _index is not None:
+            return _index
 
-                        logger.warning('failed to import %s (%s)' % (script, diagnostic(failure)))
+        where = join(dirname(__file__), 'commands')
+        scripts = manifest.read(where)
+        if scripts is None:
+            logger.debug('command manifest missing or stale, re-scanning %s' % where)
+            try:
+                scripts = manifest.write(where)
 
-            except OSError:
-                pass
+            except (IOError, OSError):
+                scripts = manifest.scan(where)
 
         #
-        # - disable .pyc generation
-        # - scan for tools to import
-        # - each .py module must have a go() callable as well as a COMMAND attribute
-        # - the COMMAND attribute tells us what the command-line invocation looks like
+        # - map each tag to its script
+        # - a tool whose tag could not be figured out statically is imported right away
         #
-        tools = {}
-        sys.dont_write_bytecode = True
-        _import('%s/commands' % dirname(__file__), tools)
+        found = {}
+        for script, js in sorted(scripts.items()):
+            if js['go']:
+                tags = js['tags'] if js['tags'] else [tool.tag for tool in [_import(script)] if tool]
+                for tag in tags:
+                    found[tag] = script
+
+        _index = found
+        return _index
+
+
+def pick(tag):
+    """
+    Returns the tool matching the specified tag, importing its script upon first use.
+    """
+
+    scripts = index()
+    with _lock:
+        if tag not in _tools:
+            _import(scripts[tag])
+
+        assert tag in _tools, 'unable to load "%s"' % tag
+        return _tools[tag]
+
+
+def load():
+    """
+    Imports all our tools upfront (e.g from a long-lived process) and returns them indexed by tag.
+    """
+
+    tools = {}
+    for tag in index():
+        try:
+            tools[tag] = pick(tag)
+
+        except AssertionError:
+            pass
+
+    return tools
+
+
+def _match(total):
+
+    #
+    # - if several tools match pick the one that comes first (e.g batch -e ls), favoring the longest tag
+    # - return the tag plus the arguments to pass (the command tokens removed), or None if nothing matched
+    #
+    def _sub(sub):
+        for i in range(len(total)-len(sub)+1):
+            if sub == total[i:i+len(sub)]:
+                return i
+        return None
+
+    positions = {tool: _sub(tool.split(' ')) for tool in index().keys()}
+    matched = sorted([tool for tool, i in positions.items() if i is not None], key=lambda tool: (positions[tool], -len(tool)))
+    if not matched:
+        return None
+
+    picked = matched[0]
+    return picked, total[len(picked.split(' ')):]
+
+
+def isolated(tokens):
+    """
+    Returns True if the command line would raise Isolated when run on the shared zookeeper session (see
+    Template.isolated()). This lets a command running several others (e.g batch) find out upfront.
+    """
+
+    matched = _match(tokens) if tokens and tokens[0] != 'help' else None
+    return matched is not None and pick(matched[0]).isolated(matched[1])
+
+
+def dispatch(tokens, proxy=None):
+    """
+    Matches the command line tokens against our tools and runs whatever tool is picked. Returns the exit code. The
+    tool will use the specified zookeeper proxy if any. Isolated is passed upwards.
+    """
+
+    try:
+
+        tools = index()
 
         def _usage():
             return 'available commands -> %s' % ', '.join(sorted(tools.keys()))
@@ -76,19 +280,12 @@ def go():
         parser = ArgumentParser(description='', prefix_chars='+', usage=_usage())
         parser.add_argument('command', type=str, help='command (e.g ls for instance)')
         parser.add_argument('extra', metavar='extra arguments', type=str, nargs='*', help='zero or more arguments')
-        args = parser.parse_args()
-        total = [args.command] + args.extra
+        args = parser.parse_args(tokens)
         if args.command == 'help':
             logger.info(_usage())
-            exit(0)
-
-        def _sub(sub):
-            for i in range(len(total)-len(sub)+1):
-                if sub == total[i:i+len(sub)]:
-                    return 1
             return 0
 
-        matched = [tool for tool in tools.keys() if _sub(tool.split(' '))]
+        matched = _match([args.command] + args.extra)
         if not matched:
 
             logger.info('unknown command (%s)' % _usage())
@@ -97,14 +294,23 @@ def go():
 
             #
             # - simply invoke the tool
-            # - remove the command tokens first and pass the rest as arguments
             # - each tool will parse its own commandline
             # - if the tool does not define an exit code default to 0 (success)
             #
-            picked = matched[0]
-            tokens = len(picked.split(' ')) - 1
-            code = tools[picked].run(args.extra[tokens:])
-            exit(0 if code is None else code)
+            picked, extra = matched
+            code = pick(picked).run(extra, proxy=proxy)
+            return 0 if code is None else code
+
+    except SystemExit as failure:
+
+        #
+        # - argparse (or the tool itself) may bail out via exit()
+        #
+        return 0 if failure.code is None else failure.code
+
+    except Isolated:
+
+        raise
 
     except AssertionError as failure:
 
@@ -114,4 +320,59 @@ def go():
 
         logger.error('shutting down <- %s' % diagnostic(failure))
 
-    exit(1)
\ No newline at end of file
+    return 1
+
+
+@contextmanager
+def capture(out):
+    """
+    Context manager routing whatever the current thread outputs (line by line) to the specified list (or Output) for
+    the duration of the block. Captures can be nested, the outer one is restored upon exit.
+    """
+
+    global _router
+    with _lock:
+        if _router is None:
+            _router = _Router()
+            logger.addHandler(_router)
+
+    ident = current_thread().ident
+    outer = _router.sinks.get(ident)
+    _router.sinks[ident] = out
+    try:
+        yield out
+
+    finally:
+        if outer is None:
+            del _router.sinks[ident]
+        else:
+            _router.sinks[ident] = outer
+
+
+def execute(tokens, out, proxy=None):
+    """
+    Runs a command line in-process, appending whatever the tool outputs (line by line) to the specified list (or
+    Output). This is meant to be invoked from a long-lived process (e.g the portal) and is thread-safe. Returns the
+    exit code, or raises Isolated if the command must be run within its own process instead.
+    """
+
+    with capture(out):
+        return dispatch(tokens, proxy=proxy)
+
+
+def go():
+    """
+    Entry point for the portal tool-set. This script will look for python modules in the /commands sub-directory. This
+    is what is invoked from within the portal's flask endpoint (e.g when the user types something in the cli)
+    """
+
+    #
+    # - start by simplifying a bit the console logger to look more CLI-ish
+    # - don't echo whatever a tool captures (e.g batch), it will output it itself
+    #
+    for handler in logger.handlers:
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+    uncaptured(logger)
+
+    exit(dispatch(sys.argv[1:]))
@@ -0,0 +1,125 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Command manifest mapping each tool tag to the script defining it. The scripts are parsed, not imported, which means
+building the manifest is cheap and does not require any of the tool dependencies. It is generated by setup.py when
+the package is built and checked against the commands directory at runtime (any script that got added, removed or
+modified since then triggers a re-scan).
+
+Please note this module must not import anything from the toolset (setup.py loads it before the package is installed).
+"""
+
+import ast
+import json
+import os
+
+from os.path import getmtime, getsize, isfile, join
+
+#: Name of the manifest file, which sits within the commands directory.
+FILE = 'manifest.json'
+
+#: Tolerance in seconds when comparing modification times (eggs are zip files and round them to 2 seconds).
+SLACK = 2.0
+
+
+def _parse(path):
+
+    #
+    # - look for classes deriving from Template and setting their tag to a string literal
+    # - also report whether the script defines a go() function (e.g whether it is a tool at all)
+    #
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+
+    tags = []
+    entry = any(isinstance(node, ast.FunctionDef) and node.name == 'go' for node in tree.body)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef) and any(getattr(base, 'id', getattr(base, 'attr', '')) == 'Template' for base in node.bases):
+            for stmt in node.body:
+                if isinstance(stmt, ast.Assign) and isinstance(stmt.value, ast.Str):
+                    if any(isinstance(target, ast.Name) and target.id == 'tag' for target in stmt.targets):
+                        tags.append(stmt.value.s)
+
+    return entry, tags
+
+
+def scan(where):
+    """
+    Parses the python scripts found in the specified directory and returns a {script: {...}} dict holding for each
+    its size, modification time, whether it defines go() and the tags it declares. A tool whose tag could not be
+    figured out statically is reported with an empty tag list.
+    """
+
+    scripts = {}
+    for script in sorted(f for f in os.listdir(where) if f.endswith('.py') and isfile(join(where, f))):
+        path = join(where, script)
+        try:
+            entry, tags = _parse(path)
+
+        except SyntaxError:
+
+            #
+            # - let the import report the problem
+            #
+            entry, tags = True, []
+
+        scripts[script] = \
+            {
+                'go': entry,
+                'mtime': getmtime(path),
+                'size': getsize(path),
+                'tags': tags
+            }
+
+    return scripts
+
+
+def write(where):
+    """
+    Scans the specified directory and writes its manifest. Returns the scripts (see scan()).
+    """
+
+    scripts = scan(where)
+    with open(join(where, FILE), 'wb') as f:
+        f.write(json.dumps({'scripts': scripts}, indent=4, sort_keys=True))
+
+    return scripts
+
+
+def read(where):
+    """
+    Returns the scripts listed in the manifest of the specified directory, or None if there is no manifest or if it is
+    stale (e.g if some script got added, removed or modified since it was written).
+    """
+
+    try:
+        with open(join(where, FILE), 'rb') as f:
+            scripts = json.loads(f.read())['scripts']
+
+    except (IOError, KeyError, ValueError):
+        return None
+
+    listed = set(f for f in os.listdir(where) if f.endswith('.py') and isfile(join(where, f)))
+    if listed != set(scripts):
+        return None
+
+    for script, js in scripts.items():
+        path = join(where, script)
+        if getsize(path) != js['size'] or abs(getmtime(path) - js['mtime']) > SLACK:
+            return None
+
+    return scripts
@@ -0,0 +1,53 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Drop-in replacements for the requests get/put/post/delete functions that the tools use to talk to marathon. Each
+call is recorded as a span when tracing is on (see toolset.trace).
+"""
+
+import requests
+
+from toolset.trace import span
+from urlparse import urlparse
+
+
+def _call(method, url, **kwargs):
+
+    with span('%s %s' % (method.upper(), urlparse(url).path), 'marathon', url=url) as args:
+        reply = requests.request(method, url, **kwargs)
+        args['code'] = reply.status_code
+        return reply
+
+
+def get(url, **kwargs):
+
+    return _call('get', url, **kwargs)
+
+
+def put(url, data=None, **kwargs):
+
+    return _call('put', url, data=data, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+
+    return _call('post', url, data=data, **kwargs)
+
+
+def delete(url, **kwargs):
+
+    return _call('delete', url, **kwargs)
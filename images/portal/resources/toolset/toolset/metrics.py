@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from threading import Lock
+
+#: Default latency buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#: Every metric family ever declared, in declaration order (see render()).
+families = []
+
+
+class _Family(object):
+
+    #: Prometheus type, as reported in the # TYPE line.
+    kind = ''
+
+    def __init__(self, name, help, labels=()):
+
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.name = name
+        self.series = {}
+        families.append(self)
+
+    def _key(self, labels):
+
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _tags(self, key, extra=None):
+
+        pairs = zip(self.labels, key) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+
+        escaped = [(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in pairs]
+        return '{%s}' % ','.join('%s="%s"' % pair for pair in escaped)
+
+    def render(self):
+
+        with self.lock:
+            series = sorted(self.series.items())
+
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        for key, value in series:
+            lines += self._lines(key, value)
+
+        return lines
+
+
+class Counter(_Family):
+    """
+    Monotonic counter, optionally broken down by labels.
+    """
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + value
+
+    def _lines(self, key, value):
+
+        return ['%s%s %s' % (self.name, self._tags(key), value)]
+
+
+class Histogram(_Family):
+    """
+    Cumulative histogram (plus sum & count), optionally broken down by labels.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.series:
+                self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+
+            counts = self.series[key]
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[n] += 1
+
+            counts[-2] += value
+            counts[-1] += 1
+
+    def _lines(self, key, counts):
+
+        lines = ['%s_bucket%s %d' % (self.name, self._tags(key, ('le', '%g' % bound)), counts[n])
+                 for n, bound in enumerate(self.buckets)]
+
+        lines.append('%s_bucket%s %d' % (self.name, self._tags(key, ('le', '+Inf')), counts[-1]))
+        lines.append('%s_sum%s %f' % (self.name, self._tags(key), counts[-2]))
+        lines.append('%s_count%s %d' % (self.name, self._tags(key), counts[-1]))
+        return lines
+
+
+def render():
+    """
+    Returns all our metrics using the Prometheus text exposition format.
+    """
+
+    lines = []
+    for family in families:
+        lines += family.render()
+
+    return '\n'.join(lines) + '\n'
+
+
+#: Time spent resolving pods, either from a registry or by walking zookeeper.
+LOOKUP_SECONDS = Histogram('ochothon_lookup_seconds', 'Pod lookup latency.', ['source'])
+
+#: Number of pods queried per fan-out.
+FANOUT_PODS = Histogram('ochothon_fanout_pods', 'Number of pods queried per fan-out.', ['command'],
+                        buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+
+#: Time spent by a fan-out, from the first query out to the last reply in.
+FANOUT_SECONDS = Histogram('ochothon_fanout_seconds', 'Fan-out latency.', ['command'])
+
+#: Latency of the pod HTTP queries that got a reply.
+POD_SECONDS = Histogram('ochothon_pod_request_seconds', 'Pod HTTP query latency.', ['cluster', 'command'])
+
+#: Pod HTTP queries that timed out or failed, per cluster (not per pod, pods come and go forever).
+POD_FAILURES = Counter('ochothon_pod_failures_total', 'Pod HTTP queries that failed.', ['cluster', 'command', 'status'])
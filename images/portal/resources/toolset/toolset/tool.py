@@ -16,17 +16,161 @@
 #
 import logging
 import os
+import time
 
 from argparse import ArgumentParser
 from logging import DEBUG
 from ochopod.core.core import ROOT
 from ochopod.core.fsm import diagnostic, shutdown
-from toolset.io import ZK
+from ochopod.core.utils import retry
+from threading import Lock
+from toolset import trace
+from toolset.io import lookup, run, scatter, session, ZK
 
 #: Our ochopod logger.
 logger = logging.getLogger('ochopod')
 
 
+class Context(object):
+    """
+    Per-invocation cache shared by whatever threads a tool runs. The pods matching a given cluster (glob) are looked
+    up once and memoized, and so are their /info replies. Tools firing several requests at the same pods can then
+    skip the redundant zookeeper walks and fan-outs. Call invalidate() whenever the pods may have changed (e.g while
+    waiting for new pods to show up).
+    """
+
+    def __init__(self, proxy):
+
+        self.infos = {}
+        self.lock = Lock()
+        self.proxy = proxy
+        self.snapshots = {}
+
+    @staticmethod
+    def _subset(js, subset, seq):
+
+        return {key: value for key, value in js.items() if not subset or seq(value) in subset}
+
+    def pods(self, cluster, subset=None):
+        """
+        Returns the pods matching the cluster glob as a {key: hints} dict (see lookup()), optionally filtered by
+        sequence index.
+        """
+
+        with self.lock:
+            pods = self.snapshots.get(cluster)
+
+        if pods is None:
+            pods = run(self.proxy, lambda zk: lookup(zk, cluster))
+            with self.lock:
+                self.snapshots[cluster] = pods
+
+        return self._subset(pods, subset, lambda hints: hints['seq'])
+
+    def survey(self, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, deadline=None, hedge=None):
+        """
+        Same as survey() except the pods come from our snapshot : every pod is reported as (seq, body, code, status).
+        The replies are not cached.
+        """
+
+        pods = self.pods(cluster, subset=subset)
+        replies = scatter(pods, command, timeout=timeout, js=js, headers=headers, files=files, deadline=deadline, hedge=hedge)
+        return {key: (seq, body, code, status) for key, seq, body, code, status in replies}
+
+    def fire(self, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, deadline=None, hedge=None):
+        """
+        Same as fire() except the pods come from our snapshot. The replies are not cached.
+        """
+
+        replies = self.survey(cluster, command, subset=subset, timeout=timeout, js=js, headers=headers, files=files, deadline=deadline, hedge=hedge)
+        return {key: (seq, body, code) for key, (seq, body, code, _) in replies.items() if code}
+
+    def stream(self, cluster, command, subset=None, timeout=5.0, js=None, headers=None, files=None, deadline=None, hedge=None):
+        """
+        Same as stream() except the pods come from our snapshot.
+        """
+
+        pods = self.pods(cluster, subset=subset)
+        for key, seq, body, code, _ in scatter(pods, command, timeout=timeout, js=js, headers=headers, files=files, deadline=deadline, hedge=hedge):
+            if code:
+                yield key, seq, body, code
+
+    def kill(self, cluster, subset=None, timeout=5.0):
+        """
+        Fires a POST /control/kill at the pods until they all report back a HTTP 410 (e.g their state-machine is now
+        idling) or until the timeout is reached. Returns the sequence indices of the pods that went down.
+        """
+
+        budget = time.time() + timeout
+        spun = \
+            {
+                'down': [],
+                'subset': subset
+            }
+
+        @retry(timeout=timeout, pause=0)
+        @trace.traced('spin')
+        def _spin():
+
+            #
+            # - warning, /control/kill will block until the pod is down
+            # - upon retrying only re-fire at the pods that are not gone yet (including the ones that timed out)
+            # - each round is bounded by whatever is left of our timeout
+            #
+            replies = self.survey(cluster, 'control/kill', subset=spun['subset'], timeout=timeout, deadline=max(budget - time.time(), 1.0))
+            js = [(code, seq) for seq, _, code, _ in replies.values()]
+            spun['down'] += [seq for code, seq in js if code == 410]
+            left = [seq for code, seq in js if code != 410]
+            if left:
+                spun['subset'] = left
+            assert not left, 'at least one pod is still running'
+            return spun['down']
+
+        return _spin()
+
+    def info(self, cluster, subset=None):
+        """
+        Returns the /info replies of the pods matching the cluster glob, as a {key: (seq, hints, code)} dict
+        (optionally filtered by sequence index). Only the pods that replied are reported.
+        """
+
+        #
+        # - re-use the replies for the whole cluster if we have them, otherwise only query the subset
+        #
+        key = (cluster, tuple(sorted(subset)) if subset else None)
+        with self.lock:
+            replies = self.infos.get((cluster, None), self.infos.get(key))
+
+        if replies is None:
+            replies = self.fire(cluster, 'info', subset=subset)
+            with self.lock:
+                self.infos[key] = replies
+
+        return self._subset(replies, subset, lambda reply: reply[0])
+
+    def invalidate(self, cluster=None):
+        """
+        Drops whatever we have for the specified cluster glob (or everything).
+        """
+
+        with self.lock:
+            if cluster is None:
+                self.infos.clear()
+                self.snapshots.clear()
+            else:
+                self.snapshots.pop(cluster, None)
+                for key in [key for key in self.infos if key[0] == cluster]:
+                    del self.infos[key]
+
+
+class Isolated(Exception):
+    """
+    Raised by Template.run() when a command is run on the shared zookeeper session with -d or --trace. Both switch
+    something process-wide on (the log handlers and the tracer), which we can't do while serving other commands. The
+    caller (e.g the portal) is expected to run the command line again within its own process.
+    """
+
+
 class Template():
     """
     High-level template setting a ZK proxy up and handling the initial command-line parsing. All the user has
@@ -42,37 +186,107 @@ class Template():
     #: If true the parser will not allow for unknown arguments
     strict = True
 
-    def run(self, cmdline):
+    def parser(self, quiet=False):
 
         class _Parser(ArgumentParser):
             def error(self, message):
-                logger.error('error: %s\n' % message)
-                self.print_help()
+                if not quiet:
+                    logger.error('error: %s\n' % message)
+                    self.print_help()
                 exit(1)
 
-        unknown = None
+            def _print_message(self, message, file=None):
+
+                #
+                # - route the help & usage through our logger (we may be running in-process)
+                #
+                if message and not quiet:
+                    logger.info(message.rstrip('\n'))
+
         parser = _Parser(prog=self.tag, description=self.help)
         self.customize(parser)
         parser.add_argument('-d', '--debug', action='store_true', help='debug mode')
+        parser.add_argument('--trace', action='store_true', help='records a timeline to %s' % trace.FILE)
+        return parser
+
+    def isolated(self, cmdline):
+        """
+        Returns True if the command line would raise Isolated when run on the shared zookeeper session. Invalid
+        command lines are left for run() to report.
+        """
+
+        try:
+            args, _ = self.parser(quiet=True).parse_known_args(cmdline)
+            return args.debug or args.trace
+
+        except SystemExit:
+            return False
+
+    def run(self, cmdline, proxy=None):
+
+        ts = time.time()
+        unknown = None
+        parser = self.parser()
         if self.strict:
             args = parser.parse_args(cmdline)
         else:
             args, unknown = parser.parse_known_args(cmdline)
+
+        #
+        # - argparse accepts abbreviations & combined switches (e.g --deb or -jd) : check what it parsed
+        # - bail out before doing anything if we are sharing the process with other commands
+        #
+        shared = session()
+        if shared is not None and (args.debug or args.trace):
+            raise Isolated('%s needs its own process (-d or --trace)' % self.tag)
+
         if args.debug:
             for handler in logger.handlers:
                 handler.setLevel(DEBUG)
 
         #
-        # - the zookeeper nodes are passed down via $OCHOPOD_ZK from the portal process
+        # - use the proxy we are given if any (e.g we are run by batch)
+        # - otherwise use the shared zookeeper session if our process has one (e.g we are running within the portal)
+        # - otherwise the zookeeper nodes are passed down via $OCHOPOD_ZK from the portal process
+        # - a private proxy is used for one command only : it looks the pods up instead of priming a registry
+        # - --trace records spans (zookeeper, pods, marathon) and dumps them in the working directory, unless
+        #   tracing is already on (e.g we are being profiled)
         #
-        proxy = ZK.start([node for node in os.environ['OCHOPOD_ZK'].split(',')])
+        parsed = time.time()
+        owned = args.trace and not trace.active()
+        if owned:
+            trace.start()
+
+        trace.record('parse', 'tool', ts, parsed - ts)
+
         try:
+            private = proxy is None and shared is None
+            if private:
+                with trace.span('start', 'zookeeper'):
+                    proxy = ZK.start([node for node in os.environ['OCHOPOD_ZK'].split(',')])
+
+            elif proxy is None:
+                proxy = shared.proxy
+
+            try:
+
+                #
+                # - the tool can use args.context to share pod lookups & /info replies between its threads
+                #
+                args.context = Context(proxy)
+                return self.body(args, unknown, proxy)
+
+            finally:
 
-            return self.body(args, unknown, proxy)
+                if private:
+                    with trace.span('shutdown', 'zookeeper'):
+                        shutdown(proxy)
 
         finally:
 
-            shutdown(proxy)
+            trace.record(self.tag, 'tool', ts, time.time() - ts, cmdline=' '.join(cmdline))
+            if owned:
+                trace.stop()
 
     def customize(self, parser):
         pass
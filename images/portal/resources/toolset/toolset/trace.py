@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2015 Autodesk Inc.
+# All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import json
+import os
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import current_thread, Lock
+
+#: Name of the file the timeline is written to (in the current working directory).
+FILE = 'trace.json'
+
+#: Active tracer, None unless tracing was turned on (see start()).
+_tracer = None
+
+
+class _Tracer(object):
+
+    def __init__(self):
+
+        self.events = []
+        self.lock = Lock()
+        self.pid = os.getpid()
+        self.threads = {}
+
+    def add(self, name, category, ts, lapse, args):
+
+        #
+        # - use complete events (ph X) with absolute timestamps in micro-seconds
+        # - this way timelines recorded by different processes line up
+        #
+        thread = current_thread()
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(
+                {
+                    'name': name,
+                    'cat': category,
+                    'ph': 'X',
+                    'ts': int(ts * 1000000),
+                    'dur': int(lapse * 1000000),
+                    'pid': self.pid,
+                    'tid': thread.ident,
+                    'args': args
+                })
+
+    def dump(self):
+
+        with self.lock:
+            named = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                     for tid, name in self.threads.items()]
+
+            return named + sorted(self.events, key=lambda event: event['ts'])
+
+
+def start():
+    """
+    Turns tracing on for the whole process.
+    """
+
+    global _tracer
+    _tracer = _Tracer()
+
+
+def stop(path=FILE):
+    """
+    Turns tracing off and writes the timeline to the specified file using the chrome trace event format (which
+    chrome://tracing or any compatible viewer can load). Returns the trace events.
+    """
+
+    global _tracer
+    if _tracer is None:
+        return []
+
+    events = _tracer.dump()
+    _tracer = None
+    with open(path, 'wb') as f:
+        f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+    return events
+
+
+def active():
+
+    return _tracer is not None
+
+
+def record(name, category, ts, lapse, **args):
+    """
+    Records a span after the fact (e.g when it started & ended on different threads).
+    """
+
+    tracer = _tracer
+    if tracer is not None:
+        tracer.add(name, category, ts, lapse, args)
+
+
+@contextmanager
+def span(name, category='toolset', **args):
+    """
+    Context manager recording whatever runs within as one span. It yields the span arguments, which can be
+    updated from within (e.g to report a HTTP code). This is a no-op unless tracing is on.
+    """
+
+    tracer = _tracer
+    if tracer is None:
+        yield args
+        return
+
+    ts = time.time()
+    try:
+        yield args
+
+    finally:
+        tracer.add(name, category, ts, time.time() - ts, args)
+
+
+def traced(name, category='toolset'):
+    """
+    Decorator recording each invocation of the wrapped function as one span. Put it under a @retry to see each
+    attempt (the gaps in between being the retry pauses).
+    """
+
+    def _decorator(func):
+
+        @wraps(func)
+        def _wrapper(*args, **kwargs):
+            with span(name, category):
+                return func(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
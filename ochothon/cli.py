@@ -44,18 +44,68 @@ You can also run a one-shot command. For instance if you just need to list all y
 """
 
 import cmd
+import gzip
 import hashlib
 import hmac
 import json
 import os
+import pipes
+import tarfile
 import tempfile
+import time
 import shutil
 
-from common import shell
-from os.path import abspath, basename, expanduser, isdir, isfile, join
+from common import shell, stream
+from os.path import abspath, basename, expanduser, isdir, isfile, islink, join, relpath
 from sys import exit
 
 
+def _sha1(path):
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while 1:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def _tgz(path, where):
+    """
+    Archives a directory the same way "tar zcf <path> *" would, except the output is deterministic (sorted entries,
+    no owner and no gzip timestamp). The same content will always yield the same bytes, which lets the proxy skip
+    uploads it already has.
+    """
+
+    names = []
+    for top in sorted(f for f in os.listdir(where) if not f.startswith('.')):
+        names.append(top)
+        full = join(where, top)
+        if isdir(full) and not islink(full):
+            for root, dirs, files in os.walk(full):
+                dirs.sort()
+                names += [relpath(join(root, name), where) for name in sorted(dirs + files)]
+
+    with open(path, 'wb') as raw:
+        gz = gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0)
+        tar = tarfile.open(fileobj=gz, mode='w')
+        for name in names:
+            info = tar.gettarinfo(join(where, name), arcname=name)
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            if info.isfile():
+                with open(join(where, name), 'rb') as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
+
+        tar.close()
+        gz.close()
+
+
 def cli(args):
 
     tmp = tempfile.mkdtemp()
@@ -78,6 +128,33 @@ def cli(args):
             def do_exit(self, _):
                 raise KeyboardInterrupt
 
+            def push(self, files):
+
+                #
+                # - hash our files and ask the proxy which ones it is missing
+                # - upload only those, the proxy checks their SHA1
+                # - return the X-Blobs header value (or None if the proxy does not support blobs)
+                #
+                hashes = {tag: _sha1(path) for tag, path in files.items()}
+                payload = json.dumps({'hashes': sorted(set(hashes.values()))})
+                code, out = shell('curl -s -X POST -H "Content-Type:application/json" -d \'%s\' %s:9000/blobs' % (payload, ip))
+                try:
+                    missing = set(json.loads(out.decode('utf-8'))['missing'])
+
+                except (KeyError, ValueError):
+                    return None
+
+                for tag, path in files.items():
+                    if hashes[tag] in missing:
+                        missing.remove(hashes[tag])
+                        digest = 'sha1=' + hmac.new(self.token, hashes[tag], hashlib.sha1).hexdigest() if self.token else ''
+                        snippet = 'curl -s -X PUT -H "X-Signature:%s" --data-binary @%s %s:9000/blobs/%s' % (digest, path, ip, hashes[tag])
+                        code, out = shell(snippet)
+                        js = json.loads(out.decode('utf-8'))
+                        assert js['ok'], 'unable to upload %s (%s)' % (tag, js['out'])
+
+                return ','.join('%s=%s' % (tag, sha1) for tag, sha1 in sorted(hashes.items()))
+
             def do_shell(self, line):
                 if line:
                     tokens = line.split(' ')
@@ -109,7 +186,7 @@ def cli(args):
                             # - the TGZ is stored in our temp. directory
                             #
                             path = join(tmp, '%s.tgz' % tag)
-                            shell('tar zcf %s *' % path, cwd=full)
+                            _tgz(path, full)
                             files['%s.tgz' % tag] = path
                             substituted += ['%s.tgz' % tag]
 
@@ -119,16 +196,55 @@ def cli(args):
                     #
                     # - compute the SHA1 signature if we have a token
                     # - prep the CURL statement and run it
-                    # - we should always get a HTTP 200 back with some UTF-8 json payload
-                    # - parse & print
+                    # - ask for a streamed reply (one UTF-8 json object per line) and print as we go
+                    # - older portals will simply send one json payload back with the whole output
+                    # - files are pushed to the proxy blob store first and referenced via X-Blobs
+                    # - fall back on a multi-part upload if the proxy does not support blobs
+                    # - several proxies may run behind the same address, in which case the /shell request can land
+                    #   on a proxy that does not have our blobs : re-send the files as a multi-part upload once
                     #
                     line = ' '.join(substituted)
-                    unrolled = ['-F %s=@%s' % (k, v) for k, v in files.items()]
-                    digest = 'sha1=' + hmac.new(self.token, line, hashlib.sha1).hexdigest() if self.token else ''
-                    snippet = 'curl -X POST -H "X-Shell:%s" -H "X-Signature:%s" %s %s:9000/shell' % (line, digest, ' '.join(unrolled), ip)
-                    code, out = shell(snippet, cwd=tmp)
-                    js = json.loads(out.decode('utf-8'))
-                    print(js['out'] if code is 0 else 'i/o failure (is the proxy down ?)')
+                    blobs = self.push(files) if files else ''
+                    if blobs is None:
+                        unrolled = ['-F %s=@%s' % (k, v) for k, v in files.items()]
+                    else:
+                        unrolled = ['-H "X-Blobs:%s"' % blobs] if blobs else []
+
+                    if self.post(line, unrolled) and files:
+                        self.post(line, ['-F %s=@%s' % (k, v) for k, v in files.items()])
+
+            def post(self, line, unrolled):
+
+                #
+                # - quote the X-Shell header, the line may contain quotes itself (e.g batch -e "grep foo")
+                # - return True if the proxy is missing some of our blobs (nothing was run in that case)
+                #
+                digest = 'sha1=' + hmac.new(self.token, line, hashlib.sha1).hexdigest() if self.token else ''
+                snippet = 'curl -N -X POST -H %s -H "X-Signature:%s" -H "X-Stream:true" %s %s:9000/shell' % (pipes.quote('X-Shell:%s' % line), digest, ' '.join(unrolled), ip)
+                replied = 0
+                for raw in stream(snippet, cwd=tmp):
+                    js = json.loads(raw.decode('utf-8'))
+                    replied = 1
+                    if 'missing' in js:
+                        return True
+                    elif 'line' in js:
+                        print(js['line'])
+                    elif 'out' in js:
+                        print(js['out'])
+
+                    #
+                    # - commands run with --trace get their timeline back, save it in the current directory
+                    #
+                    if 'trace' in js:
+                        path = abspath('trace-%d.json' % int(1000 * time.time()))
+                        with open(path, 'wb') as f:
+                            f.write(json.dumps({'traceEvents': js['trace'], 'displayTimeUnit': 'ms'}))
+                        print('trace saved @ %s (load it in chrome://tracing)' % path)
+
+                if not replied:
+                    print('i/o failure (is the proxy down ?)')
+
+                return False
 
         #
         # - partition ip and args by looking for OCHOPOD_PROXY first
@@ -30,4 +30,17 @@ def shell(snippet, cwd=None, env=None):
         elif line:
             out += [line.rstrip('\n')]
 
-    return pid.returncode, '\n'.join(out)
\ No newline at end of file
+    return pid.returncode, '\n'.join(out)
+
+
+def stream(snippet, cwd=None, env=None):
+    """
+    Same as shell() except the stdout lines are yielded as they come. The exit code is not returned and the stderr
+    output is discarded.
+    """
+
+    pid = Popen(snippet, shell=True, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env)
+    for line in iter(pid.stdout.readline, b''):
+        yield line.rstrip('\n')
+
+    pid.communicate()